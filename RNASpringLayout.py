@@ -1,24 +1,42 @@
+import time
 import numpy as np
+from multiprocessing import Pool
+from scipy.spatial import cKDTree
 from scipy.spatial.distance import pdist, squareform
 
+from RNAtrace import Trace
+
 class SpringLayout:
-    def __init__(self,reachability,posInit=None, width=600,height=600,pointsize=0.04):
+    def __init__(self,reachability,posInit=None, width=600,height=600,pointsize=0.04,dtype=float,
+                 repulsion='auto',theta=0.5):
         self.gCnst   = 100
         self.eCnst   = 10000
         self.sCnst   = 0.01
         self.sLength = 30
         self.damping = 0.98
 
+        self.dtype   = np.dtype(dtype)
+
+        #'exact' sums the repulsion over all N^2 pairs, 'barnesHut' approximates distant groups
+        #of nodes by their centre of mass (smaller theta is more accurate), 'auto' picks by size
+        self.repulsion = repulsion
+        self.theta     = theta
+        self.leafSize  = 4          #average number of nodes per finest Barnes-Hut cell
+
         self.setbounds(width,height)
-        self.rch = np.asarray(reachability[0])
-        self.numPts = self.rch[0].shape[0]
+        self.numPts = np.asarray(reachability[0]).shape[0]
         self.size = pointsize
 
         self.colors = np.array([[0,0,1],[0,1,0],[1,0,0],[0,1,1],[1,0,1],[1,1,0]])
 
+        self.layerOrder = list(range(len(reachability)))
         if len(reachability) ==3:
             self.colors = np.array([[0,0,1],[1,0,0],[0,1,0]])
-            reachability.append(reachability.pop(1))
+            self.layerOrder = [0,2,1]       #draw the network's bonds over the known structure
+        self.layerSrc   = [None]*len(reachability)       #copy of each layer, to spot the ones that changed
+        self.layerEdges = [None]*len(reachability)       #(pairs,weights,colors) of each layer
+        self.edgeVersion = 0        #bumped whenever the edges (and so segColor) change
+        self.trace = None           #an RNAtrace.Trace, see traceOn
 
         posInit = np.asarray(posInit)
         if posInit.shape != (self.numPts,2):
@@ -26,46 +44,87 @@ class SpringLayout:
             posInit = np.vstack((np.cos(angles),np.sin(angles))).transpose()*self.bounds[0,1]/1.4
 
         self.clicked  = -1
-        self.state    = np.hstack((posInit,np.zeros((self.numPts,2))))      # (x,y,vx,vy) for each node
+        self.state    = np.hstack((posInit,np.zeros((self.numPts,2)))).astype(self.dtype)      # (x,y,vx,vy) for each node
 
         self.chgWeights(reachability)
 
     def chgWeights(self,newRch):
-        self.rch      = np.zeros((self.numPts,self.numPts))
-        self.pairs    = np.zeros((0,2))
-        self.segments = np.zeros((0,2,2))
-        self.segColor = np.zeros((0,8))
-
+        #layers equal to the previous call keep their edges, so after an epoch only the
+        #bonds layer is rebuilt; the edge arrays are then concatenated once
+        newRch  = [newRch[x] for x in self.layerOrder]
+        changed = False
         for i,x in enumerate(newRch):
             x = np.asarray(x)
+            if self.layerSrc[i] is not None and np.array_equal(x,self.layerSrc[i]):
+                continue
+            changed = True
+            self.layerSrc[i] = x.copy()
+
             x = x+x.transpose()
-            self.rch += x*(20**i)
             xpairs    = np.transpose(np.nonzero(np.triu(x)))         #unique node-number pairs for existing connections
-            xsegments = np.asarray([[self.state[p1,:2],self.state[p2,:2]] for p1,p2 in xpairs])
-            xsegAlpha = np.transpose(np.triu(x)[np.nonzero(np.triu(x))])/x.max()        #make alpha proportional to connection strength
-            xsegColor = np.hstack( (  np.ones((xsegments.shape[0],3))*self.colors[i,:].transpose()   ,   xsegAlpha[:,np.newaxis]  ) )
-            xsegColor = np.hstack((xsegColor,xsegColor))
-
-            self.pairs    = np.vstack((self.pairs,xpairs))
-            self.segments = np.vstack((self.segments,xsegments))
-            self.segColor = np.vstack((self.segColor,xsegColor))
-
-        self.rch /= self.rch.max()
+            xweights  = x[xpairs[:,0],xpairs[:,1]]
+            xsegAlpha = xweights/x.max() if xweights.size else xweights        #make alpha proportional to connection strength
+            xsegColor = np.empty((xpairs.shape[0],8),dtype=np.float32)      #RGBA for both ends, ready for OpenGL
+            xsegColor[:,0:3] = self.colors[i,:]
+            xsegColor[:,3]   = xsegAlpha
+            xsegColor[:,4:]  = xsegColor[:,:4]
+            self.layerEdges[i] = (xpairs,xweights*(20**i),xsegColor)
+
+        if not changed:
+            return
+        self.edgeVersion += 1
+
+        self.pairs    = np.concatenate([e[0] for e in self.layerEdges]).astype(np.intp)
+        self.pairWeights = np.concatenate([e[1] for e in self.layerEdges]).astype(self.dtype)
+        self.segColor = np.concatenate([e[2] for e in self.layerEdges])
+        self.segments = np.empty((self.pairs.shape[0],2,2),dtype=self.dtype)     #reused by every step
+        self.updateSegments()
+
+        #spring strengths, normalized by the strongest connection (layers can share a pair)
+        pairKeys = self.pairs[:,0]*self.numPts+self.pairs[:,1]
+        inverse  = np.unique(pairKeys,return_inverse=True)[1]
+        if self.pairWeights.size:
+            self.pairWeights /= np.bincount(inverse,weights=self.pairWeights).max()
+
+    def updateSegments(self):
+        #line end points for every edge, gathered straight into the segments buffer
+        np.take(self.state[:,:2],self.pairs,axis=0,out=self.segments)
 
 
     def setbounds(self,width,height):
-        self.bounds = np.array([-0.5,0.5])*(np.array((width,height))[:,np.newaxis])
+        self.bounds = (np.array([-0.5,0.5])*(np.array((width,height))[:,np.newaxis])).astype(self.dtype)
 
-    def step(self,dt):
-        distance = squareform(pdist(self.state[:, :2]))
-        np.fill_diagonal(distance,1)        #prevents NaN error
-        direction = self.state[:, :2]-self.state[:,np.newaxis,:2]
+    def traceOn(self,size=10000):
+        #records the time of every step and of its repulsion part from now on
+        self.trace = Trace(('seconds','repulsion'),size)
+        return self.trace
 
-        eForce = direction/(distance**3)[...,np.newaxis]
-        eForce = np.sum(eForce, axis=1) * self.eCnst
+    def traceOff(self):
+        self.trace = None
 
-        sForce = -direction*(self.rch*(distance-self.sLength))[...,np.newaxis]
-        sForce = np.sum(sForce, axis=1) * self.sCnst
+    def step(self,dt):
+        trace = self.trace
+        if trace is not None:
+            start = time.perf_counter()
+        pos = self.state[:, :2]
+
+        if self.repulsion == 'exact' or (self.repulsion == 'auto' and self.numPts <= 256):
+            eForce = self.exactRepulsion(pos)
+        else:
+            eForce = self.barnesHutRepulsion(pos)
+        eForce *= self.eCnst
+        if trace is not None:
+            repulsionTime = time.perf_counter()-start
+
+        #springs act only along the edges in self.pairs
+        p1,p2 = self.pairs[:,0],self.pairs[:,1]
+        direction = pos[p2]-pos[p1]
+        distance  = np.sqrt(np.sum(direction**2,axis=1))
+        pull = direction*(self.pairWeights*(distance-self.sLength))[:,np.newaxis]
+        sForce = np.zeros_like(pos)
+        for c in range(2):
+            sForce[:,c] = np.bincount(p2,pull[:,c],self.numPts)-np.bincount(p1,pull[:,c],self.numPts)
+        sForce *= self.sCnst
 
         gForce  =  self.state[:,:2]/np.abs(np.sum(self.state[:2]**2)) *self.gCnst
 
@@ -88,8 +147,98 @@ class SpringLayout:
 
 
         #find line positions
-        self.segments =np.asarray([[self.state[p1,:2],self.state[p2,:2]] for p1,p2 in self.pairs])
+        self.updateSegments()
 
+        if trace is not None:
+            trace.record(time.perf_counter()-start,repulsionTime)
+
+    def exactRepulsion(self,pos):
+        #sum over every pair of (pos[b]-pos[a])/|pos[b]-pos[a]|^3; O(N^2) time and memory
+        distance = squareform(pdist(pos)).astype(self.dtype,copy=False)
+        np.fill_diagonal(distance,1)        #prevents NaN error
+        direction = pos-pos[:,np.newaxis]
+        return np.sum(direction/(distance**3)[...,np.newaxis], axis=1)
+
+    def barnesHutRepulsion(self,pos):
+        #same sum as exactRepulsion, O(N log N)
+        #the nodes are binned into a hierarchy of square grids (an implicit quadtree)
+        #cells more than ws cells away from a node's cell, whose parents were still neighbours,
+        #act through their centre of mass; nodes in neighbouring finest cells are summed exactly
+        #ws = ceil(1/theta) keeps the size/distance ratio of every approximated cell below theta
+        n  = pos.shape[0]
+        ws = max(1,int(np.ceil(1/self.theta)))
+        origin = pos.min(axis=0)
+        side   = max((pos.max(axis=0)-origin).max(),1e-9)*(1+1e-9)
+        levels = max(1,int(np.ceil(np.log2(np.sqrt(n/self.leafSize)))))
+        force  = np.zeros_like(pos)
+
+        #children of the parent's neighbours that aren't neighbours themselves, relative to the
+        #node's own cell; they depend only on which corner of its parent the cell is in
+        offsets = np.arange(-2*ws-1,2*ws+2)
+        offsets = np.array([(dx,dy) for dx in offsets for dy in offsets if max(abs(dx),abs(dy)) > ws])
+        farOff  = []
+        for qx,qy in ((0,0),(0,1),(1,0),(1,1)):
+            inParentNbr = np.all(np.abs((offsets+(qx,qy))//2) <= ws,axis=1)
+            farOff.append(offsets[inParentNbr])
+        farOff = np.array(farOff)
+
+        for level in range(1,levels+1):
+            g = 2**level
+            cell = np.minimum(((pos-origin)*(g/side)).astype(int),g-1)
+            cellId = cell[:,0]*g+cell[:,1]
+            mass = np.bincount(cellId,minlength=g*g).astype(pos.dtype)
+            comX = np.bincount(cellId,pos[:,0],g*g)/np.maximum(mass,1)
+            comY = np.bincount(cellId,pos[:,1],g*g)/np.maximum(mass,1)
+
+            off = farOff[(cell[:,0]%2)*2+cell[:,1]%2]
+            cx  = cell[:,0,np.newaxis]+off[...,0]
+            cy  = cell[:,1,np.newaxis]+off[...,1]
+            valid  = (cx>=0) & (cx<g) & (cy>=0) & (cy<g)
+            candId = np.where(valid,cx*g+cy,0)
+            weight = np.where(valid,mass[candId],0)
+
+            dx = comX[candId]-pos[:,0,np.newaxis]
+            dy = comY[candId]-pos[:,1,np.newaxis]
+            r2 = dx*dx+dy*dy
+            np.putmask(r2,weight==0,1)
+            weight /= r2*np.sqrt(r2)
+            force[:,0] += np.sum(dx*weight,axis=1)
+            force[:,1] += np.sum(dy*weight,axis=1)
+
+        #exact sum over node pairs in neighbouring finest cells
+        cellSize = side/2**levels
+        pairs = cKDTree(pos).query_pairs((ws+1)*cellSize*np.sqrt(2),output_type='ndarray')
+        cell  = np.minimum(((pos-origin)/cellSize).astype(int),2**levels-1)
+        pairs = pairs[np.abs(cell[pairs[:,0]]-cell[pairs[:,1]]).max(axis=1) <= ws]
+        a,b = pairs[:,0],pairs[:,1]
+        direction = pos[b]-pos[a]
+        distance  = np.sqrt(np.sum(direction**2,axis=1))
+        push = direction/(distance**3)[:,np.newaxis]
+        for c in range(2):
+            force[:,c] += np.bincount(a,push[:,c],n)-np.bincount(b,push[:,c],n)
+        return force
+
+    def settleStep(self,dt):
+        #one step, returning the kinetic energy per node of the motion it caused
+        #the energy comes from how far the nodes actually moved, since nodes pressed
+        #against the bounds keep their (capped) velocity without going anywhere
+        lastPos = self.state[:,:2].copy()
+        self.step(dt)
+        return 0.5*np.sum(((self.state[:,:2]-lastPos)/dt)**2)/self.numPts
+
+    def relax(self,dt=1/30,maxSteps=5000,energyTol=0.5,patience=100):
+        #steps the layout without a display until the kinetic energy per node has stayed
+        #below energyTol for patience steps in a row (the layout starts at rest, so a single
+        #quiet step means nothing) or maxSteps is reached
+        #returns the number of steps and the final energy
+        energy = np.inf
+        quiet  = 0
+        for x in range(maxSteps):
+            energy = self.settleStep(dt)
+            quiet = quiet+1 if energy < energyTol else 0
+            if quiet >= patience:
+                return x+1,energy
+        return maxSteps,energy
 
     def freezeClosest(self,x,y):
 
@@ -110,5 +259,26 @@ class SpringLayout:
         self.clicked = -1
 
 
-
-
+def relaxLayout(job):
+    #worker for layoutBatch
+    graph,width,height,dt,maxSteps,energyTol,patience = job
+    spl = SpringLayout(graph,width=width,height=height)
+    steps,energy = spl.relax(dt,maxSteps,energyTol,patience)
+    return spl.state[:,:2].copy(),steps,energy
+
+
+def layoutBatch(graphs,fileName=None,processes=None,width=600,height=600,dt=1/30,maxSteps=5000,energyTol=0.5,
+                patience=100):
+    #relaxes the layout of every graph (a list of reachability layers, as RNAssNetwork.graph)
+    #in a process pool and returns the node coordinates; with a fileName they are also
+    #saved to an .npz as layout0, layout1, ... together with the steps and final energies
+    jobs = [(graph,width,height,dt,maxSteps,energyTol,patience) for graph in graphs]
+    with Pool(processes) as pool:
+        results = pool.map(relaxLayout,jobs)
+
+    layouts = [pos for pos,steps,energy in results]
+    if fileName is not None:
+        arrays = dict(('layout%d'%x,pos) for x,pos in enumerate(layouts))
+        np.savez_compressed(fileName,steps=np.array([r[1] for r in results]),
+                            energy=np.array([r[2] for r in results]),**arrays)
+    return layouts
@@ -0,0 +1,190 @@
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+from RNAdataset import FoldResult, StrandStore
+from RNASpringLayout import SpringLayout
+from RNAssNetwork import RNAlearner, RNAssNetwork
+
+
+#benchmarks of the folding, layout and table hot paths
+#   python RNAbench.py --out bench.json
+#   python RNAbench.py --baseline bench.json --threshold 0.25
+#every case is timed over a few repeats (best and median wall time are kept) and its peak
+#traced allocation is recorded; with a baseline, cases whose best time grew by more than
+#the threshold are listed and the exit status is 1
+
+
+def timeCase(func,repeats=3):
+    #func() does the setup and returns the callable to time
+    times = []
+    peak = 0
+    for r in range(repeats):
+        target = func()
+        tracemalloc.start()
+        start = time.perf_counter()
+        target()
+        times.append(time.perf_counter()-start)
+        peak = max(peak,tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    return {'best':min(times),'median':float(np.median(times)),'peakBytes':peak}
+
+
+def syntheticSequence(n,seed=0):
+    return ''.join(np.random.default_rng(seed+n).choice(list('ACGU'),n))
+
+
+def sampleSequences(sizes):
+    #(case name,sequence) for the strands of RNAstrands plus synthetic ones of the given sizes
+    store = StrandStore('RNAstrands.store')
+    seqs = [('strand%d'%k,store.sequence(k)) for k in range(len(store))]
+    return seqs+[('n=%d'%n,syntheticSequence(n)) for n in sizes]
+
+
+def hairpinGraph(n,stem):
+    #backbone plus a stem of the first stem bases with the last ones
+    return FoldResult('N'*n,[(i,n-1-i) for i in range(stem)]).graph
+
+
+def benchConstruct(sizes,repeats):
+    #building a network, without the shared interactions cache; past denseMax the
+    #matrix-free operator is the only one that fits in memory
+    out = {}
+    for case,seq in sampleSequences(sizes):
+        matrixFree = len(seq) > denseMax
+        out[case] = timeCase(lambda: lambda: RNAssNetwork(seq,cache=None,matrixFree=matrixFree),repeats)
+        out[case]['matrixFree'] = matrixFree
+    return out
+
+
+def benchEpoch(sizes,repeats):
+    out = {}
+    for case,seq in sampleSequences(sizes):
+        epochs = min(20,max(2,20000//len(seq)))       #fewer on the long strands
+        net = RNAssNetwork(seq,matrixFree=len(seq) > denseMax)
+        res = timeCase(lambda: lambda: [net.epoch() for x in range(epochs)],repeats)
+        res['epochsPerSecond'] = epochs/res['best']
+        out[case] = res
+    return out
+
+
+def benchDelta(sizes,repeats):
+    out = {}
+    learner = RNAlearner()
+    for case,seq in sampleSequences([n for n in sizes if n <= deltaMax]):
+        net = RNAssNetwork(seq)
+        net.run(50,save=False)
+        target = hairpinGraph(len(seq),len(seq)//4)[1]
+        out[case] = timeCase(lambda: lambda: learner.delta(target,net.bonds),repeats)
+    return out
+
+
+def benchLayoutStep(sizes,repeats,steps=10):
+    out = {}
+    for n in sizes:
+        spl = SpringLayout(hairpinGraph(n,n//3))
+        res = timeCase(lambda: lambda: [spl.step(1/30) for x in range(steps)],repeats)
+        res['stepsPerSecond'] = steps/res['best']
+        res['repulsion'] = 'exact' if spl.repulsion == 'exact' or (spl.repulsion == 'auto' and n <= 256) else 'barnesHut'
+        out['n=%d'%n] = res
+    return out
+
+
+def benchChgWeights(sizes,repeats):
+    out = {}
+    for n in sizes:
+        graphs = [hairpinGraph(n,n//3),hairpinGraph(n,n//4)]
+        spl = SpringLayout(graphs[0])
+        flip = [0]
+        def setup():
+            flip[0] ^= 1        #alternate, so the bonds layer really changes every call
+            return lambda: spl.chgWeights(graphs[flip[0]])
+        out['n=%d'%n] = timeCase(setup,repeats)
+    return out
+
+
+def benchTableData(sizes,repeats,calls=10000):
+    try:
+        from PySide import QtCore
+        from tableviews import WeightTableModel
+    except ImportError:
+        return {'skipped':'PySide is not installed'}
+    out = {}
+    rng = np.random.default_rng(0)
+    for n in [n for n in sizes if n <= deltaMax]:
+        net = RNAssNetwork(syntheticSequence(n))
+        model = WeightTableModel(np.asarray(net.interactions))
+        cells = [model.index(int(r),int(c)) for r,c in rng.integers(0,net.interactions.shape[0],(calls,2))]
+        roles = (QtCore.Qt.DisplayRole,QtCore.Qt.BackgroundRole)
+        res = timeCase(lambda: lambda: [model.data(i,role) for i in cells for role in roles],repeats)
+        res['callsPerSecond'] = 2*calls/res['best']
+        out['n=%d'%n] = res
+    return out
+
+
+denseMax = 120      #largest strand given a dense P x P interactions matrix (P = n^2/2)
+deltaMax = 120      #RNAlearner.delta and the table models are O(P^2) in memory too
+
+suites = {'construct'  : (benchConstruct,[100,120,250,500,1000,2000,4000]),
+          'epoch'      : (benchEpoch,[100,120,250,500,1000,2000,4000]),
+          'delta'      : (benchDelta,[100,120]),
+          'layoutStep' : (benchLayoutStep,[100,250,500,1000,2000,4000]),
+          'chgWeights' : (benchChgWeights,[100,250,500,1000,2000,4000]),
+          'tableData'  : (benchTableData,[76,100])}
+
+
+def compare(results,baseline,threshold):
+    #(suite,case,baseline best,new best) for every case that got slower by more than threshold
+    slower = []
+    for suite,cases in results['suites'].items():
+        for case,res in cases.items():
+            old = baseline.get('suites',{}).get(suite,{}).get(case)
+            if isinstance(res,dict) and isinstance(old,dict) and 'best' in res and 'best' in old:
+                if res['best'] > old['best']*(1+threshold):
+                    slower.append((suite,case,old['best'],res['best']))
+    return slower
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the folding, layout and table hot paths.')
+    parser.add_argument('--out',default='bench.json',help='where to write the results')
+    parser.add_argument('--suite',action='append',choices=sorted(suites),help='run only these suites')
+    parser.add_argument('--repeats',type=int,default=3)
+    parser.add_argument('--maxSize',type=int,default=None,help='skip synthetic sizes above this')
+    parser.add_argument('--baseline',default=None,help='results of an earlier run to compare against')
+    parser.add_argument('--threshold',type=float,default=0.2,help='allowed slowdown, as a fraction')
+    args = parser.parse_args()
+
+    results = {'python':platform.python_version(),'numpy':np.__version__,
+               'machine':platform.machine(),'time':time.strftime('%Y-%m-%d %H:%M:%S'),
+               'suites':{}}
+    for name in args.suite or sorted(suites):
+        bench,sizes = suites[name]
+        if args.maxSize is not None:
+            sizes = [n for n in sizes if n <= args.maxSize]
+        start = time.perf_counter()
+        results['suites'][name] = bench(sizes,args.repeats)
+        print('%s: %d cases in %.1fs'%(name,len(results['suites'][name]),time.perf_counter()-start))
+        for case,res in results['suites'][name].items():
+            if isinstance(res,dict):
+                print('    %-8s %10.4fs  %8.1f MB'%(case,res['best'],res['peakBytes']/2**20))
+            else:
+                print('    %s: %s'%(case,res))
+
+    with open(args.out,'w') as file:
+        json.dump(results,file,indent=1)
+
+    if args.baseline is not None:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        slower = compare(results,baseline,args.threshold)
+        for suite,case,old,new in slower:
+            print('REGRESSION %s %s: %.4fs -> %.4fs (+%.0f%%)'%(suite,case,old,new,100*(new/old-1)))
+        if slower:
+            sys.exit(1)
+        print('no case slower than the baseline by more than %.0f%%'%(100*args.threshold))
@@ -0,0 +1,251 @@
+import json
+import os
+import pickle as pkl
+import sys
+
+import numpy as np
+from scipy.sparse import coo_matrix
+
+
+#a strand store is a directory holding
+#   sequences.bin   every sequence, one byte per base, back to back
+#   pairs.bin       every structure as int32 (i,j) pairs with i<j, back to back
+#   index.npy       one record per strand locating its sequence and pairs in the two files
+#   info.json       the number of strands and the dataset title
+#the .bin files are memory-mapped, so opening a store and reading strand k costs the same
+#whatever its size
+indexType = np.dtype([('seqStart','<i8'),('seqLen','<i4'),
+                      ('pairStart','<i8'),('numPairs','<i4'),('structSize','<i4')])
+
+
+def mapFile(fileName,dtype):
+    if os.path.getsize(fileName) == 0:      #mmap can't map an empty file
+        return np.zeros(0,dtype=dtype)
+    return np.memmap(fileName,dtype=dtype,mode='r')
+
+
+class StrandStore:
+    def __init__(self,path):
+        self.path = path
+        with open(os.path.join(path,'info.json')) as file:
+            info = json.load(file)
+        self.title = tuple(info['title']) if info['title'] is not None else None
+        self.index = np.load(os.path.join(path,'index.npy'),mmap_mode='r')
+        self.seqData = mapFile(os.path.join(path,'sequences.bin'),np.uint8)
+        self.pairData = mapFile(os.path.join(path,'pairs.bin'),np.int32).reshape(-1,2)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self,k):
+        return self.sequence(k),self.structure(k)
+
+    def __iter__(self):
+        for k in range(len(self)):
+            yield self[k]
+
+    def sequence(self,k):
+        rec = self.index[k]
+        start = rec['seqStart']
+        return self.seqData[start:start+rec['seqLen']].tobytes().decode('ascii')
+
+    def pairs(self,k):
+        #(numPairs,2) array of the paired bases; None if strand k has no structure
+        rec = self.index[k]
+        if rec['structSize'] < 0:
+            return None
+        start = rec['pairStart']
+        return np.array(self.pairData[start:start+rec['numPairs']])
+
+    def structure(self,k):
+        #the dense upper-triangular matrix the .rna pickle used to hold
+        rec = self.index[k]
+        if rec['structSize'] < 0:
+            return None
+        struct = np.zeros((rec['structSize'],rec['structSize']),dtype=int)
+        pairs = self.pairs(k)
+        struct[pairs[:,0],pairs[:,1]] = 1
+        return struct
+
+
+class StrandWriter:
+    #appends strands to a new store one at a time, so a collection never has to fit in memory
+    def __init__(self,path,title=None):
+        self.path = path
+        self.title = title
+        os.makedirs(path,exist_ok=True)
+        self.seqFile = open(os.path.join(path,'sequences.bin'),'wb')
+        self.pairFile = open(os.path.join(path,'pairs.bin'),'wb')
+        self.records = []
+        self.seqPos = 0
+        self.pairPos = 0
+
+    def add(self,sequence,struct=None):
+        #struct is an n x n matrix with a 1 at (i,j) for each pair, or an array of (i,j) pairs
+        seq = sequence.encode('ascii')
+        if struct is None:
+            pairs = np.zeros((0,2),dtype=np.int32)
+            size = -1
+        else:
+            struct = np.asarray(struct)
+            if struct.ndim == 2 and struct.shape[0] == struct.shape[1] and struct.shape[1] != 2:
+                size = struct.shape[0]
+                pairs = np.transpose(np.nonzero(np.triu(struct+struct.transpose())))
+            else:
+                size = len(seq)
+                pairs = np.sort(struct.reshape(-1,2),axis=1)
+            pairs = pairs.astype(np.int32)
+
+        self.seqFile.write(seq)
+        self.pairFile.write(pairs.tobytes())
+        self.records.append((self.seqPos,len(seq),self.pairPos,len(pairs),size))
+        self.seqPos += len(seq)
+        self.pairPos += len(pairs)
+
+    def close(self):
+        self.seqFile.close()
+        self.pairFile.close()
+        np.save(os.path.join(self.path,'index.npy'),np.array(self.records,dtype=indexType))
+        with open(os.path.join(self.path,'info.json'),'w') as file:
+            json.dump({'count':len(self.records),'title':self.title},file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc):
+        self.close()
+
+
+def bondPairs(bonds):
+    #(numPairs,2) array of the pairs set in a pruned bonds matrix, i<j
+    return np.transpose(np.nonzero(np.triu(np.asarray(bonds)) > 0.5)).astype(np.int32)
+
+
+def dotBracket(pairs,seqSize):
+    #dot-bracket string for a list of (i,j) pairs; crossing pairs go into [], {} and <>
+    #a base already paired keeps its first pair, since the notation can't show a second
+    brackets = ['()','[]','{}','<>']
+    out = ['.']*seqSize
+    levels = [[] for b in brackets]
+    for i,j in sorted((int(i),int(j)) for i,j in pairs):
+        if out[i] != '.' or out[j] != '.':
+            continue
+        for b,level in zip(brackets,levels):
+            if not any(k < i < l < j for k,l in level):
+                level.append((i,j))
+                out[i],out[j] = b
+                break
+    return ''.join(out)
+
+
+def readDotBracket(db):
+    #(numPairs,2) array of the pairs in a dot-bracket string, the inverse of dotBracket
+    stacks = {}
+    pairs = []
+    for x,ch in enumerate(db):
+        for b in ('()','[]','{}','<>'):
+            if ch == b[0]:
+                stacks.setdefault(b,[]).append(x)
+            elif ch == b[1]:
+                pairs.append((stacks[b].pop(),x))
+    return np.array(sorted(pairs),dtype=np.int32).reshape(-1,2)
+
+
+class FoldResult:
+    #what a fold leaves behind, in O(n) rather than O(n^2): the pruned pairs and, optionally,
+    #the pre-prune activations as a sparse n x n matrix
+    def __init__(self,sequence,pairs,activations=None):
+        self.sequence = sequence
+        self.pairs = np.asarray(pairs,dtype=np.int32).reshape(-1,2)
+        self.activations = None if activations is None else coo_matrix(activations)
+
+    @classmethod
+    def fromNetwork(cls,net,activations=False):
+        #activations keeps the state from just before prune()
+        acts = None
+        if activations:
+            state = net.activation if net.activation is not None else net.state
+            nz = np.nonzero(state)[0]
+            acts = coo_matrix((state[nz].astype(np.float32),(net.vecInd[0][nz],net.vecInd[1][nz])),
+                              shape=(net.seqSize,net.seqSize))
+        return cls(net.sequence,bondPairs(net.bonds),acts)
+
+    @classmethod
+    def fromDotBracket(cls,sequence,db):
+        return cls(sequence,readDotBracket(db))
+
+    @property
+    def seqSize(self):
+        return len(self.sequence)
+
+    @property
+    def dotBracket(self):
+        return dotBracket(self.pairs,self.seqSize)
+
+    @property
+    def bonds(self):
+        bonds = np.zeros((self.seqSize,self.seqSize))
+        bonds[self.pairs[:,0],self.pairs[:,1]] = 1
+        return bonds
+
+    @property
+    def graph(self):
+        #the reachability layers SpringLayout expects, as RNAssNetwork.graph
+        backBone = np.zeros((self.seqSize,self.seqSize))
+        backBone[range(self.seqSize-1),range(1,self.seqSize)] = 1
+        return [backBone,self.bonds]
+
+
+def saveResults(fileName,results):
+    #many FoldResults in one .npz: everything is concatenated and located by offsets
+    seqs = [r.sequence.encode('ascii') for r in results]
+    acts = [r.activations for r in results]
+    hasActs = np.array([a is not None for a in acts])
+    acts = [a if a is not None else coo_matrix((r.seqSize,r.seqSize)) for r,a in zip(results,acts)]
+    np.savez(fileName,
+             sequences   = np.frombuffer(b''.join(seqs),dtype=np.uint8),
+             seqOffsets  = np.cumsum([0]+[len(s) for s in seqs]),
+             pairs       = np.concatenate([r.pairs for r in results]+[np.zeros((0,2),dtype=np.int32)]),
+             pairOffsets = np.cumsum([0]+[len(r.pairs) for r in results]),
+             hasActs     = hasActs,
+             actRows     = np.concatenate([a.row for a in acts]+[[]]).astype(np.int32),
+             actCols     = np.concatenate([a.col for a in acts]+[[]]).astype(np.int32),
+             actVals     = np.concatenate([a.data for a in acts]+[[]]).astype(np.float32),
+             actOffsets  = np.cumsum([0]+[a.nnz for a in acts]))
+
+
+def loadResults(fileName):
+    with np.load(fileName) as data:
+        seqData,seqOff = data['sequences'],data['seqOffsets']
+        pairs,pairOff = data['pairs'],data['pairOffsets']
+        actRows,actCols,actVals,actOff = data['actRows'],data['actCols'],data['actVals'],data['actOffsets']
+        hasActs = data['hasActs']
+
+    results = []
+    for k in range(len(hasActs)):
+        seq = seqData[seqOff[k]:seqOff[k+1]].tobytes().decode('ascii')
+        acts = None
+        if hasActs[k]:
+            a,b = actOff[k],actOff[k+1]
+            acts = coo_matrix((actVals[a:b],(actRows[a:b],actCols[a:b])),shape=(len(seq),len(seq)))
+        results.append(FoldResult(seq,pairs[pairOff[k]:pairOff[k+1]],acts))
+    return results
+
+
+def convertPickle(pickleName,storeName):
+    #converts a .rna pickle (a title tuple followed by (sequence,matrix) tuples) into a store
+    with open(pickleName,mode='rb') as file:
+        rnaData = pkl.load(file)
+    title = None
+    if rnaData and not isinstance(rnaData[0][1],(list,np.ndarray)):
+        title,rnaData = list(rnaData[0]),rnaData[1:]
+    with StrandWriter(storeName,title) as writer:
+        for seq,struct in rnaData:
+            writer.add(seq,struct)
+    return StrandStore(storeName)
+
+
+if __name__ == '__main__':
+    #python RNAdataset.py RNAstrands.rna RNAstrands.store
+    store = convertPickle(sys.argv[1],sys.argv[2])
+    print('%d strands written to %s'%(len(store),sys.argv[2]))
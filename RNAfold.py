@@ -0,0 +1,153 @@
+import argparse
+import json
+import os
+import time
+from itertools import islice
+from multiprocessing import Pool
+
+from RNAdataset import StrandStore, saveResults
+from RNAssNetwork import foldBatch
+
+
+#folds every sequence of a FASTA file or strand store and writes the results as it goes
+#   python RNAfold.py strands.fa --out run1 --bonds
+#the run directory gets
+#   structures.tsv      index, name, sequence and dot-bracket of every strand, in input order
+#   bonds_<first>.npz   with --bonds, the FoldResults of a block with their pre-prune activations
+#                       (see RNAdataset.loadResults)
+#   progress.json       how far the run got; rerunning with the same --out carries on from there
+#sequences are read a chunk at a time, so memory stays bounded whatever the input size
+
+
+def readFasta(fileName):
+    #yields (name,sequence) for each record, one at a time
+    name,parts = None,[]
+    with open(fileName) as file:
+        for line in file:
+            line = line.strip()
+            if line.startswith('>'):
+                if name is not None:
+                    yield name,''.join(parts)
+                name,parts = line[1:].strip(),[]
+            elif line and not line.startswith(';'):
+                parts.append(line)
+    if name is not None:
+        yield name,''.join(parts)
+
+
+def readStrands(path):
+    #yields (name,sequence) from a FASTA file or a strand store directory
+    if os.path.isdir(path):
+        store = StrandStore(path)
+        for k in range(len(store)):
+            yield str(k),store.sequence(k)
+    else:
+        for record in readFasta(path):
+            yield record
+
+
+def foldChunk(job):
+    #worker: folds one chunk of sequences and returns the FoldResult of each (with the
+    #pre-prune activations only if they are to be saved), or the error that stopped it
+    sequences,epochs,tol,wobble,activations = job
+    try:
+        results = foldBatch(sequences,epochs,tol=tol,wobble=wobble,results=True)
+    except Exception as error:
+        return repr(error)
+    if not activations:
+        for r in results:
+            r.activations = None
+    return results
+
+
+def cleanSequence(seq):
+    seq = seq.upper().replace('T','U')
+    if seq and set(seq) <= set('ACGU'):
+        return seq
+
+
+def foldFile(inName,outDir,epochs=500,tol=1e-6,wobble=False,saveBonds=False,
+             chunkSize=32,processes=None):
+    os.makedirs(outDir,exist_ok=True)
+    tsvName = os.path.join(outDir,'structures.tsv')
+    progName = os.path.join(outDir,'progress.json')
+
+    #resume: drop anything written after the last recorded chunk
+    done,tsvBytes = 0,0
+    if os.path.exists(progName):
+        with open(progName) as file:
+            prog = json.load(file)
+        if os.path.abspath(prog['input']) != os.path.abspath(inName):
+            raise ValueError('%s holds a run over %s, not %s'%(outDir,prog['input'],inName))
+        done,tsvBytes = prog['done'],prog['tsvBytes']
+        print('resuming %s after %d sequences'%(outDir,done))
+    tsv = open(tsvName,'ab')
+    tsv.truncate(tsvBytes)
+
+    records = islice(readStrands(inName),done,None)
+    workers = processes or os.cpu_count()
+    pool = Pool(workers)
+    start = time.time()
+    count = 0
+    try:
+        while True:
+            #one chunk per worker in flight at a time
+            block = list(islice(records,chunkSize*workers))
+            if not block:
+                break
+            index = list(range(done,done+len(block)))
+            valid = [(x,name,cleanSequence(seq)) for x,(name,seq) in zip(index,block)]
+            for x,name,seq in valid:
+                if seq is None:
+                    print('skipping %d (%s): not an RNA sequence'%(x,name))
+            valid = [v for v in valid if v[2] is not None]
+
+            jobs = [([seq for x,name,seq in valid[c:c+chunkSize]],epochs,tol,wobble,saveBonds)
+                    for c in range(0,len(valid),chunkSize)]
+            folded = []
+            for c,chunk in zip(range(0,len(valid),chunkSize),pool.map(foldChunk,jobs)):
+                if isinstance(chunk,str):
+                    #a chunk that fails is logged and left out, so a resume doesn't hit it again
+                    first,last = valid[c][0],valid[min(c+chunkSize,len(valid))-1][0]
+                    print('chunk %d-%d failed, skipping it: %s'%(first,last,chunk))
+                    chunk = [None]*len(jobs[c//chunkSize][0])
+                folded += chunk
+            folded = [(v,r) for v,r in zip(valid,folded) if r is not None]
+
+            lines = ['%d\t%s\t%s\t%s\n'%(x,name,seq,r.dotBracket) for (x,name,seq),r in folded]
+            tsv.write(''.join(lines).encode())
+            tsv.flush()
+            os.fsync(tsv.fileno())
+            if saveBonds and folded:
+                saveResults(os.path.join(outDir,'bonds_%08d.npz'%done),[r for v,r in folded])
+
+            done += len(block)
+            count += len(block)
+            tmpName = progName+'.tmp'
+            with open(tmpName,'w') as file:
+                json.dump({'done':done,'tsvBytes':tsv.tell(),'input':os.path.abspath(inName)},file)
+            os.replace(tmpName,progName)       #the chunk only counts once this lands
+
+            elapsed = time.time()-start
+            print('%d sequences done, %.1f seq/s'%(done,count/elapsed))
+    finally:
+        pool.close()
+        pool.join()
+        tsv.close()
+    return done
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fold every sequence of a FASTA file or strand store.')
+    parser.add_argument('input',help='FASTA file or strand store directory')
+    parser.add_argument('--out',default=None,help='run directory (default fold_<time>); reuse it to resume')
+    parser.add_argument('--epochs',type=int,default=500)
+    parser.add_argument('--tol',type=float,default=1e-6)
+    parser.add_argument('--wobble',action='store_true',help='allow G-U pairs')
+    parser.add_argument('--bonds',action='store_true',help='also save the pairs and pre-prune activations of each strand')
+    parser.add_argument('--chunk',type=int,default=32,help='sequences per worker job')
+    parser.add_argument('--processes',type=int,default=None)
+    args = parser.parse_args()
+
+    outDir = args.out or time.strftime('fold_%Y%m%d_%H%M%S')
+    foldFile(args.input,outDir,args.epochs,args.tol,args.wobble,args.bonds,args.chunk,args.processes)
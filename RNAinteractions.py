@@ -0,0 +1,217 @@
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from scipy.sparse.linalg import LinearOperator
+
+
+def pairIndexTable(seqSize,vecInd):
+    #n x n table giving the position of pair (i,j) in the state vector, or -1 if it isn't one
+    table = np.full((seqSize,seqSize),-1,dtype=np.intp)
+    table[vecInd] = np.arange(len(vecInd[0]))
+    return table
+
+
+def pairMasks(vecInd,maxStack=3):
+    #P x P boolean masks relating each pair p=(i,j) to every pair q=(k,l) after it in vecInd
+    #(only the upper triangle is set); 'd' holds the row difference k-i
+    i = np.asarray(vecInd[0],dtype=np.int32)[:,np.newaxis]
+    j = np.asarray(vecInd[1],dtype=np.int32)[:,np.newaxis]
+    k = i.transpose()
+    l = j.transpose()
+
+    d = k-i
+    after = np.triu(np.ones(d.shape,dtype=bool),1)
+    later = after & (d>0)               #q starts on a later row
+    outer = later & (j<l)               #...and ends after p
+
+    stack = later & (l==j-d)
+    if maxStack is not None:
+        stack &= d<=maxStack
+
+    return {'d'      : d,
+            'rowCol' : after & ((d==0) | (l==j)),   #same row or column
+            'knot'   : outer & (k<j),               #crossing pairs
+            'shared' : outer & (k==j),              #(i,j) and (j,l) share base j
+            'outer'  : outer,
+            'stack'  : stack}                       #stacked neighbours (i+d,j-d)
+
+
+def interactionMatrix(seqSize,weights,vecInd=None,dtype=float,maxStack=3,strictKnots=True):
+    #dense interactions matrix built in one pass over all (pair,pair) combinations
+    #maxStack=None stimulates stacked pairs at any distance and strictKnots=False
+    #inhibits every pair that isn't nested, as in firstMatrix.py
+    rcInhibit,knotInhib,diagStim = weights
+    if vecInd is None:
+        vecInd = np.triu_indices(seqSize,4)
+    masks = pairMasks(vecInd,maxStack)
+    d = masks['d']
+
+    w = np.zeros(d.shape,dtype=dtype)
+    w[masks['rowCol']] = rcInhibit
+    if strictKnots:
+        w[masks['knot']] = knotInhib
+        shared = masks['shared']
+        w[shared] = np.where(d[shared]>4,rcInhibit,knotInhib)     #(i,i+4) with (i+4,l) counts as a knot
+    else:
+        w[masks['outer']] = knotInhib
+    stack = masks['stack']
+    w[stack] = diagStim/d[stack]
+
+    w += w.transpose()
+    return w
+
+
+def conflictFreeGroups(interactions):
+    #splits the pairs into groups with no interaction inside any group (greedy colouring of
+    #the nonzero pattern), so that each group can be updated at once without its members
+    #seeing each other's change; returns a list of index arrays, the largest groups first
+    numPairs = interactions.shape[0]
+    colors = np.full(numPairs,-1)
+    used = np.zeros(numPairs+1,dtype=bool)
+    for p in range(numPairs):
+        taken = colors[(np.asarray(interactions[p]) != 0) & (colors >= 0)]
+        used[taken] = True
+        colors[p] = np.argmin(used)
+        used[taken] = False
+    groups = [np.nonzero(colors == c)[0] for c in range(colors.max(initial=-1)+1)]
+    groups.sort(key=len,reverse=True)
+    return groups
+
+
+class InteractionCache:
+    #process-wide store of read-only interactions matrices, keyed by (seqSize,weights,dtype)
+    #least recently used matrices are dropped once the total exceeds maxBytes;
+    #with a cacheDir the matrices are also saved as .npy files and memory-mapped back
+    def __init__(self,maxBytes=2**29,cacheDir=None):
+        self.maxBytes = maxBytes
+        self.cacheDir = cacheDir
+        self.entries  = OrderedDict()
+        self.nbytes   = 0
+        self.hits     = 0
+        self.misses   = 0
+        self.lock     = threading.Lock()
+
+    def key(self,seqSize,weights,dtype=float):
+        return (int(seqSize),tuple(float(w) for w in weights),np.dtype(dtype).str)
+
+    def get(self,seqSize,weights,dtype=float):
+        key = self.key(seqSize,weights,dtype)
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            self.misses += 1
+
+        matrix = self.load(key)
+        if matrix is None:
+            matrix = interactionMatrix(seqSize,weights,dtype=dtype)
+            matrix = self.save(key,matrix)
+        matrix.flags.writeable = False
+
+        with self.lock:
+            if key not in self.entries and matrix.nbytes <= self.maxBytes:
+                self.entries[key] = matrix
+                self.nbytes += matrix.nbytes
+                while self.nbytes > self.maxBytes:
+                    oldKey,old = self.entries.popitem(last=False)
+                    self.nbytes -= old.nbytes
+            return self.entries.get(key,matrix)
+
+    def fileName(self,key):
+        seqSize,weights,dtype = key
+        return os.path.join(self.cacheDir,'interactions_%d_%s_%s.npy'%(
+                            seqSize,'_'.join(repr(w) for w in weights),dtype.strip('<>|=')))
+
+    def load(self,key):
+        if self.cacheDir is None:
+            return None
+        fName = self.fileName(key)
+        if os.path.exists(fName):
+            return np.load(fName,mmap_mode='r')
+
+    def save(self,key,matrix):
+        if self.cacheDir is None:
+            return matrix
+        os.makedirs(self.cacheDir,exist_ok=True)
+        fName = self.fileName(key)
+        tmpName = '%s.%d.tmp'%(fName,os.getpid())
+        with open(tmpName,'wb') as file:
+            np.save(file,matrix)
+        os.replace(tmpName,fName)       #atomic, so concurrent runs never see a partial file
+        return np.load(fName,mmap_mode='r')
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+
+interactionCache = InteractionCache()      #shared by every RNAssNetwork in the process
+
+
+class InteractionOperator(LinearOperator):
+    #matrix-free version of RNAssNetwork.interactions
+    #only the pair indices are stored; each product is built from row/column sums,
+    #2D prefix sums (for the knots) and shifted reads (for the stacking terms),
+    #so memory is O(P) rather than O(P^2)
+    pad = 4     #border around the working grid so that shifted reads never leave it
+
+    def __init__(self,seqSize,weights,vecInd=None,dtype=float):
+        self.seqSize = seqSize
+        self.rcInhibit,self.knotInhib,self.diagStim = weights
+        if vecInd is None:
+            vecInd = np.triu_indices(seqSize,4)
+        self.rows = np.asarray(vecInd[0])
+        self.cols = np.asarray(vecInd[1])
+        numPairs = self.rows.size
+        LinearOperator.__init__(self,np.dtype(dtype),(numPairs,numPairs))
+
+        #(i,i+4) with (i+4,l) is weighted as a knot rather than a shared base
+        self.compWeight = np.where(self.cols-self.rows==4,self.knotInhib,self.rcInhibit).astype(self.dtype)
+
+    def _matvec(self,x):
+        return self._matmat(np.reshape(x,(-1,1)))[:,0]
+
+    def _rmatvec(self,x):
+        return self._matvec(x)      #the interactions are symmetric
+
+    def _adjoint(self):
+        return self
+
+    def _matmat(self,X):
+        n,pad = self.seqSize,self.pad
+        r,c = self.rows,self.cols
+        X = np.asarray(X,dtype=self.dtype)
+
+        grid = np.zeros((n+2*pad,n+2*pad,X.shape[1]),dtype=self.dtype)
+        grid[r+pad,c+pad] = X
+        core = grid[pad:n+pad,pad:n+pad]
+
+        rowSum = core.sum(axis=1)
+        colSum = core.sum(axis=0)
+
+        cum = np.zeros((n+1,n+1,X.shape[1]),dtype=self.dtype)      #cum[a,b] = sum of core[:a,:b]
+        cum[1:,1:] = core.cumsum(axis=0).cumsum(axis=1)
+
+        def box(k0,k1,l0,l1):
+            return cum[k1,l1]-cum[k0,l1]-cum[k1,l0]+cum[k0,l0]
+
+        #same row or column
+        out = self.rcInhibit*(rowSum[r]+colSum[c]-2*X)
+
+        #pairs sharing a base through the other end: (i,j)-(j,l) and (k,i)-(i,j)
+        out += self.compWeight[:,np.newaxis]*rowSum[c]
+        out += self.rcInhibit*colSum[r]
+        out += (self.knotInhib-self.rcInhibit)*grid[r+pad-4,r+pad]
+
+        #knots: i<k<j<l and k<i<l<j
+        out += self.knotInhib*(box(r+1,c,c+1,n)+box(0,r,r+1,c))
+
+        #stacked neighbours (i+d,j-d) and (i-d,j+d)
+        for d in range(1,4):
+            out += self.diagStim/d*(grid[r+pad+d,c+pad-d]+grid[r+pad-d,c+pad+d])
+
+        return out
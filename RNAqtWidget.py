@@ -2,17 +2,22 @@
 
 import sys
 import math
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from PySide import QtCore, QtGui, QtOpenGL
 
+from RNAdataset import StrandStore
 from RNASpringLayout import SpringLayout
 from RNAssNetwork import RNAssNetwork
+from RNAtrace import Trace
 from tableviews import *
+from traceviews import TraceView
 
 import numpy as np
 import ctypes
 import pyglet.gl as gl
 import pyglet
-import pickle as pkl
 
 class RNAmainWindow(QtGui.QWidget):
     def __init__(self,parent,sequence,width=800,height=800,struct=None):
@@ -21,6 +26,7 @@ class RNAmainWindow(QtGui.QWidget):
         self.glWidget = GLWidget(self,sequence,width,height,struct=struct)
         self.structView = None
         self.weightView = None
+        self.traceView  = None
 
         mainLayout = QtGui.QVBoxLayout()
         mainLayout.addWidget(self.glWidget)
@@ -46,11 +52,16 @@ class RNAmainWindow(QtGui.QWidget):
         self.animBtn.clicked.connect(self.animTog)
         mvBtnLayout.addWidget(self.animBtn)
 
+        self.traceBtn = QtGui.QCheckBox("Trace")
+        self.traceBtn.clicked.connect(self.traceTog)
+        mvBtnLayout.addWidget(self.traceBtn)
+
         self.setWindowTitle(self.tr("SpringLayout"))
 
+        #the layout runs on its own thread, so the timer only has to repaint at display rate
         self.timer    = QtCore.QTimer()
         self.timer.timeout.connect(self.glWidget.update)
-        self.timer.setInterval(0)
+        self.timer.setInterval(16)
         self.timer.start()
 
     def showWeights(self):
@@ -66,12 +77,77 @@ class RNAmainWindow(QtGui.QWidget):
         else:
             self.structView = StructTableView(
                     bonds = self.glWidget.secStruct.bonds,
-                    interactions = self.glWidget.secStruct.interactions)
+                    interactions = self.glWidget.secStruct.interactions,
+                    pairIndex = self.glWidget.secStruct.pairIndex)
             self.structView.show()
 
     def animTog(self):
-        self.glWidget.anim = self.animBtn.isChecked()
-
+        self.glWidget.setAnim(self.animBtn.isChecked())
+
+    def traceTog(self):
+        #tracing costs nothing until it's switched on here
+        if not self.traceBtn.isChecked():
+            self.glWidget.setTrace(False)
+            if self.traceView is not None:
+                self.traceView.hide()
+            return
+        glw = self.glWidget
+        glw.setTrace(True)
+        net,spl = glw.secStruct.trace,glw.spl.trace
+        self.traceView = TraceView(sources=[('fold residual',net,'residual'),
+                                            ('fold energy',net,'energy'),
+                                            ('active pairs',net,'activePairs'),
+                                            ('epoch time (s)',net,'seconds'),
+                                            ('layout step time (s)',spl,'seconds'),
+                                            ('repulsion time (s)',spl,'repulsion'),
+                                            ('paintGL time (s)',glw.trace,'seconds')])
+        self.traceView.show()
+
+
+
+class LayoutThread(threading.Thread):
+    #advances the spring layout at a fixed timestep, off the GUI thread
+    #it sleeps while animation is off or once the layout has come to rest, until wake() is called
+    def __init__(self,spl,lock,dt=1/30,stepsPerSecond=60,energyTol=0.5,patience=30):
+        threading.Thread.__init__(self,daemon=True)
+        self.spl  = spl
+        self.lock = lock
+        self.dt   = dt
+        self.interval  = 1/stepsPerSecond
+        self.energyTol = energyTol
+        self.patience  = patience
+
+        self.anim    = False
+        self.settled = False
+        self.quiet   = 0
+        self.frame   = 0        #number of steps taken, for the GUI to spot new positions
+        self.wakeEvent = threading.Event()
+
+    def wake(self):
+        self.settled = False
+        self.quiet   = 0
+        self.wakeEvent.set()
+
+    def run(self):
+        nextTime = time.perf_counter()
+        while True:
+            if not self.anim or self.settled:
+                self.wakeEvent.wait()
+                self.wakeEvent.clear()
+                nextTime = time.perf_counter()
+                continue
+
+            with self.lock:
+                energy = self.spl.settleStep(self.dt)
+                dragging = self.spl.clicked != -1
+            self.frame += 1
+
+            self.quiet = self.quiet+1 if energy < self.energyTol else 0
+            if self.quiet >= self.patience and not dragging:
+                self.settled = True
+
+            nextTime += self.interval
+            time.sleep(max(0,nextTime-time.perf_counter()))
 
 
 class GLWidget(QtOpenGL.QGLWidget):
@@ -81,11 +157,36 @@ class GLWidget(QtOpenGL.QGLWidget):
         self.setFocusPolicy(QtCore.Qt.ClickFocus)
         self.secStruct = RNAssNetwork(sequence,struct=struct)
 
-        self.spl = SpringLayout(self.secStruct.graph,width=width,height=height)
+        self.spl = SpringLayout(self.secStruct.graph,width=width,height=height,dtype=np.float32)     #float32 so it can go to OpenGL as is
         self.centre = np.array([width,height])/2
         self.width  = width
         self.height = height
-        self.anim = False
+
+        #the layout and the folding run off the GUI thread; lock guards the layout arrays
+        self.lock   = threading.Lock()
+        self.layoutThread = LayoutThread(self.spl,self.lock)
+        self.layoutThread.start()
+        self.folder = ThreadPoolExecutor(max_workers=1)
+        self.dirty  = True          #something besides the layout changed since the last paint
+        self.paintedFrame = -1
+        self.trace  = None          #an RNAtrace.Trace of paintGL times, see setTrace
+
+    def setAnim(self,anim):
+        self.layoutThread.anim = anim
+        self.layoutThread.wake()
+
+    def setTrace(self,on):
+        #times the folding epochs, the layout steps and the repaints
+        if on:
+            self.secStruct.traceOn()
+            with self.lock:
+                self.spl.traceOn()
+            self.trace = Trace(('seconds',))
+        else:
+            self.secStruct.traceOff()
+            with self.lock:
+                self.spl.traceOff()
+            self.trace = None
 
     def minimumSizeHint(self):
         return QtCore.QSize(100, 100)
@@ -103,11 +204,33 @@ class GLWidget(QtOpenGL.QGLWidget):
 
         gl.glEnableClientState(gl.GL_VERTEX_ARRAY)
 
+        #persistent vertex buffers: line colours are uploaded only when the edges change,
+        #line and point positions are streamed into their buffers once per frame
+        buffers = (gl.GLuint*3)()
+        gl.glGenBuffers(3,buffers)
+        self.lineVbo,self.colorVbo,self.pointVbo = buffers
+        gl.glBindBuffer(gl.GL_ARRAY_BUFFER,self.pointVbo)
+        gl.glBufferData(gl.GL_ARRAY_BUFFER,self.spl.state.nbytes,None,gl.GL_STREAM_DRAW)
+        gl.glBindBuffer(gl.GL_ARRAY_BUFFER,0)
+        self.edgeVersion = -1
+
+    def uploadEdges(self):
+        segColor = self.spl.segColor
+        gl.glBindBuffer(gl.GL_ARRAY_BUFFER,self.colorVbo)
+        gl.glBufferData(gl.GL_ARRAY_BUFFER,segColor.nbytes,segColor.ctypes.data,gl.GL_STATIC_DRAW)
+        gl.glBindBuffer(gl.GL_ARRAY_BUFFER,self.lineVbo)
+        gl.glBufferData(gl.GL_ARRAY_BUFFER,self.spl.segments.nbytes,None,gl.GL_STREAM_DRAW)
+        gl.glBindBuffer(gl.GL_ARRAY_BUFFER,0)
+        self.edgeVersion = self.spl.edgeVersion
+
     def resizeGL(self, width, height):
         print('resize')
         self.centre = np.array([width,height])/2
         self.width,self.height = width,height
-        self.spl.setbounds(width,height)
+        with self.lock:
+            self.spl.setbounds(width,height)
+        self.layoutThread.wake()
+        self.dirty = True
 
         gl.glViewport(0, 0, width, height)
         gl.glMatrixMode(gl.GL_PROJECTION)
@@ -118,66 +241,110 @@ class GLWidget(QtOpenGL.QGLWidget):
     def mousePressEvent(self, event):
         self.lastX,self.lastY = event.x(),event.y()
         x,y = event.x()-self.centre[0],self.centre[1] - event.y()
-        print(self.spl.freezeClosest(x,y))
+        with self.lock:
+            print(self.spl.freezeClosest(x,y))
+        self.layoutThread.wake()
+        self.dirty = True
 
     def mouseReleaseEvent(self,event):
-        self.spl.releaseClicked()
+        with self.lock:
+            self.spl.releaseClicked()
+        self.layoutThread.wake()
+        self.dirty = True
 
     def mouseMoveEvent(self, event):
         dx = event.x()  - self.lastX
         dy = self.lastY - event.y()
         self.lastX,self.lastY = event.x(),event.y()
-        self.spl.moveClicked(dx,dy)
+        with self.lock:
+            self.spl.moveClicked(dx,dy)
+        self.layoutThread.wake()
+        self.dirty = True
 
     def keyPressEvent(self,event):
         key = event.key()
         if key == QtCore.Qt.Key_Space:
-            self.secStruct.epoch()
-            self.spl.chgWeights(self.secStruct.graph)
+            future = self.folder.submit(self.refold,self.secStruct.epoch)
         elif key == QtCore.Qt.Key_P:
-            self.secStruct.prune()
-            self.spl.chgWeights(self.secStruct.graph)
+            future = self.folder.submit(self.refold,self.secStruct.prune)
+        else:
+            return
+        future.add_done_callback(self.refoldDone)
+
+    def refoldDone(self,future):
+        #an exception on the folding thread would otherwise vanish with the future
+        error = future.exception()
+        if error is not None:
+            print('refold failed: %r'%error)
+
+    def refold(self,action):
+        #runs on the folding thread, so long sequences don't freeze the window
+        action()
+        graph = self.secStruct.graph
+        with self.lock:
+            self.spl.chgWeights(graph)
+        self.layoutThread.wake()
+        self.dirty = True
 
     def paintGL(self):
-        gl.glClear(gl.GL_COLOR_BUFFER_BIT)
-        gl.glLoadIdentity()
-
-        #draw lines
-        gl.glEnableClientState(gl.GL_COLOR_ARRAY)
-
-        self.lineVerts = (self.spl.segments+self.centre).flatten()
-        self.lineVerts_gl = (gl.GLfloat * len(self.lineVerts))(*self.lineVerts)
-        self.lineColors = (self.spl.segColor).flatten()
-        self.lineColors_gl = (gl.GLfloat * len(self.lineColors))(*self.lineColors)
-
-        gl.glVertexPointer(2, gl.GL_FLOAT,0, self.lineVerts_gl)
-        gl.glColorPointer(4,gl.GL_FLOAT,0,self.lineColors_gl)
-        gl.glDrawArrays(gl.GL_LINES, 0, len(self.lineVerts) //2)
-
-        gl.glDisableClientState(gl.GL_COLOR_ARRAY)
-
-        #draw points
-        gl.glColor3f (1.0, 1.0, 1.0)
-        vertPoints = (self.spl.state[:,:2]+self.centre).flatten().astype(ctypes.c_float)
-        vertices_gl = vertPoints.ctypes.data_as(ctypes.POINTER(ctypes.c_float))
-        gl.glVertexPointer(2, gl.GL_FLOAT, 0, vertices_gl)
-        gl.glDrawArrays(gl.GL_POINTS, 0, len(vertPoints) // 2)
-
-        #overdraw selected point
-        if self.spl.clicked != -1:
-            gl.glColor3f (1.0, 0.0, 0.0)
-            point = (self.spl.clickedState[:2]+self.centre).astype(ctypes.c_float)
-            point_gl = point.ctypes.data_as(ctypes.POINTER(ctypes.c_float))
-            gl.glVertexPointer(2, gl.GL_FLOAT, 0, point_gl)
-            gl.glDrawArrays(gl.GL_POINTS, 0, 1)
+        trace = self.trace
+        if trace is not None:
+            start = time.perf_counter()
+        with self.lock:
+            self.dirty = False
+            self.paintedFrame = self.layoutThread.frame
+
+            gl.glClear(gl.GL_COLOR_BUFFER_BIT)
+            gl.glLoadIdentity()
+
+            if self.edgeVersion != self.spl.edgeVersion:
+                self.uploadEdges()
+
+            gl.glPushMatrix()
+            gl.glTranslatef(self.centre[0],self.centre[1],0)
+
+            #draw lines
+            gl.glEnableClientState(gl.GL_COLOR_ARRAY)
+
+            segments = self.spl.segments
+            gl.glBindBuffer(gl.GL_ARRAY_BUFFER,self.lineVbo)
+            gl.glBufferSubData(gl.GL_ARRAY_BUFFER,0,segments.nbytes,segments.ctypes.data)
+            gl.glVertexPointer(2,gl.GL_FLOAT,0,0)
+            gl.glBindBuffer(gl.GL_ARRAY_BUFFER,self.colorVbo)
+            gl.glColorPointer(4,gl.GL_FLOAT,0,0)
+            gl.glDrawArrays(gl.GL_LINES, 0, 2*len(segments))
+
+            gl.glDisableClientState(gl.GL_COLOR_ARRAY)
+
+            #draw points, straight from the (x,y,vx,vy) rows of the layout state
+            gl.glColor3f (1.0, 1.0, 1.0)
+            state = self.spl.state
+            gl.glBindBuffer(gl.GL_ARRAY_BUFFER,self.pointVbo)
+            gl.glBufferSubData(gl.GL_ARRAY_BUFFER,0,state.nbytes,state.ctypes.data)
+            gl.glVertexPointer(2, gl.GL_FLOAT, state.strides[0], 0)
+            gl.glDrawArrays(gl.GL_POINTS, 0, len(state))
+            gl.glBindBuffer(gl.GL_ARRAY_BUFFER,0)
+
+            #overdraw selected point
+            if self.spl.clicked != -1:
+                gl.glColor3f (1.0, 0.0, 0.0)
+                point = self.spl.clickedState[:2].astype(ctypes.c_float)
+                point_gl = point.ctypes.data_as(ctypes.POINTER(ctypes.c_float))
+                gl.glVertexPointer(2, gl.GL_FLOAT, 0, point_gl)
+                gl.glDrawArrays(gl.GL_POINTS, 0, 1)
+
+            gl.glPopMatrix()
 
         pyglet.text.Label("Epoch: %s"%self.secStruct.epochCount,x=5,y=10,
                           font_name='Times New Roman',font_size=20).draw()
+        if trace is not None:
+            trace.record(time.perf_counter()-start)
 
-    def update(self,dt=1/30):
-        if self.anim:
-            self.spl.step(dt)
-        self.updateGL()
+    def update(self):
+        #repaint only when the layout moved or something else changed; once the layout has
+        #settled and nothing is dragged, the window stops redrawing altogether
+        if self.dirty or self.paintedFrame != self.layoutThread.frame:
+            self.updateGL()
 
 
 
@@ -190,10 +357,8 @@ if __name__ == '__main__':
     #seq = 'AAACCCAUGCAUAGGGUUUG'
     #seq = 'AACUAAGUU'
 
-    with open('RNAstrands.rna',mode='rb') as file:
-        rnaData = pkl.load(file)
-    seq = rnaData[2][0]
-    struct = rnaData[2][1]
+    rnaData = StrandStore('RNAstrands.store')
+    seq,struct = rnaData[1]
     print(len(seq))
     print(len(struct))
 
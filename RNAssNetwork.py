@@ -1,21 +1,30 @@
 import numpy as np
-import scipy.linalg as linalg
-import itertools
+import time
 from math import sqrt
+from multiprocessing import Pool
+from scipy.special import xlogy
+
+from RNAdataset import FoldResult
+from RNAinteractions import InteractionOperator, conflictFreeGroups, interactionCache, interactionMatrix, pairIndexTable, pairMasks
+from RNAtrace import Trace
 
 
 class RNAssNetwork:
-    def __init__(self,sequence,weights=None,struct=None):
+    def __init__(self,sequence,weights=None,struct=None,matrixFree=False,cache=interactionCache,
+                 compressed=False,wobble=False,dtype=float,interactions=None):
         sequence = sequence.upper()
+        self.sequence = sequence
+        self.dtype = np.dtype(dtype)
         self.seqSize = len(sequence)
         self.epochCount = 0
+        self.residual   = np.inf
+        self.learnCst  = 0.4
         if weights is not None:
             self.rcInhibit,self.knotInhib,self.diagStim = weights
         else:
             self.rcInhibit = -2/self.seqSize**2   #works for size 3
             self.knotInhib = -1/self.seqSize**2
             self.diagStim  = .4
-            self.learnCst  = 0.4
 
 ##            self.rcInhibit = -1/self.seqSize**1.5   #works for size 3
 ##            self.knotInhib = -1/self.seqSize**1.5
@@ -23,126 +32,547 @@ class RNAssNetwork:
 ##            self.learnCst  = 0.4
 
         baseDict = {'U':1,'G':2,'C':3,'A':4}
-        matData  = itertools.product(sequence,repeat=2)
-        matData = [baseDict[x[0]]+baseDict[x[1]] for x in matData]
-
-        self.bonds = np.array(matData).reshape((self.seqSize,self.seqSize))
+        codes    = np.array([baseDict[x] for x in sequence])
+        pairSum  = codes[:,np.newaxis]+codes[np.newaxis,:]
+        self.codes      = codes         #kept for mutate
+        self.wobble     = wobble
+        self.compressed = compressed
 
         #set bonds[i,j] = 1 for all watson-crick pairings i,j
-        self.bonds = (self.bonds==5)*0.5    # +(conn==3)   #This would also consider G-U wobble pairs
+        bonds = (pairSum==5)*0.5
+        if wobble:
+            bonds += (pairSum==3)*0.5      #G-U wobble pairs
 
-        self.bonds = np.triu(self.bonds,4)      #removes loops smaller than 3 bp
-        self.backBone = np.zeros((self.seqSize,self.seqSize))
+        bonds = np.triu(bonds,4).astype(self.dtype)      #removes loops smaller than 3 bp
+        self.backBone = np.zeros((self.seqSize,self.seqSize),dtype=self.dtype)
         self.backBone[range(self.seqSize-1),range(1,self.seqSize)] = 1     #backbone
 
-
-        #creating the interactions matrix (for use with row-based triu)
-        diags = [(np.ones((x,x))-np.eye(x))*self.rcInhibit for x in range(self.seqSize-4,0,-1)]
-
-        self.interactions = linalg.block_diag(*diags).astype(float)
-
-        rOffset=0
-        cOffset=0
-
-        for d in range(1,self.seqSize-4):            #blockset diagonal - equivalent to row difference in the adjacency matrix
-            diags = []                          #holder for the blocks for the diagonal
-
-            for cn in range(self.seqSize-4-d,0,-1):                          #height for the block
-                block = np.zeros((cn,cn+d))                                  #initialize the block
-                block[range(cn),  range(d,cn+d)  ]  = self.rcInhibit         #inhibition along the block's diagonal d
-                if d<4:
-                    block[range(cn-d),range(2*d,cn+d)]  = self.diagStim/d        #stimulation along the block's diagonal d*2
-                block += np.tril(np.ones((cn,cn+d))*self.knotInhib, d-1)     #knot inhibition below the block's diagonal d
-                if d>4 :
-                    block[:,d-4].fill(self.rcInhibit)   #complementary row/column
-                    block[:,0:(d-4)].fill(0)        #These aren't knots
-                diags.append(block)
-
-            diagBlocks = linalg.block_diag(*diags).astype(float)     #create block diagonal matrix for this diagonal
-
-            rOffset += self.seqSize-3-d
-            cOffset -= d
-
-            self.interactions[rOffset:,:cOffset] +=diagBlocks
-            self.interactions[:cOffset,rOffset:] +=diagBlocks.transpose()
-
-
-        self.vecInd  = np.triu_indices_from(self.bonds,4)                  #indices to pull the working vector out of the adjacency matrix
-        self.bondMask = self.bonds[np.triu_indices_from(self.bonds,4)]*2         #a mask that allows for only accepted pairings
-        self.bonds0 = (self.bonds*2).copy()     #the initial structure
-
-        if struct is not None:
-            self.graph = [self.backBone,self.bonds,np.array(struct)]
-            print(self.graph[0].shape)
-            print(self.graph[1].shape)
-            print(self.graph[2].shape)
+        #indices to pull the working vector out of the adjacency matrix
+        #compressed keeps only the pairs the sequence allows; the others never leave 0,
+        #so dropping them changes nothing but the size of the problem
+        if compressed:
+            self.vecInd = np.nonzero(bonds)
         else:
-            self.graph = [self.backBone,self.bonds]
-
-
-    def actFunc(self,x):
-        out = np.tanh(x)       #sigmoid, output on (0,1)
+            self.vecInd = np.triu_indices_from(bonds,4)
+        self.pairIndex = pairIndexTable(self.seqSize,self.vecInd)       #(i,j) -> position in the state vector
+        weights = (self.rcInhibit,self.knotInhib,self.diagStim)
+
+        if interactions is not None:
+            #borrowed from another network of the same length, weights and compression
+            if interactions.shape[0] != len(self.vecInd[0]):
+                raise ValueError('interactions of shape %s for %d candidate pairs'%(interactions.shape,len(self.vecInd[0])))
+            self.interactions = interactions
+        elif matrixFree:
+            #O(P) operator computing the same products as the dense matrix
+            self.interactions = InteractionOperator(self.seqSize,weights,self.vecInd,dtype=self.dtype)
+        elif compressed:
+            self.interactions = interactionMatrix(self.seqSize,weights,self.vecInd,dtype=self.dtype)
+        else:
+            #creating the interactions matrix (for use with row-based triu)
+            #it depends only on the length and weights, so strands of equal length share one read-only copy
+            if cache is not None:
+                self.interactions = cache.get(self.seqSize,weights,dtype=self.dtype)
+            else:
+                self.interactions = interactionMatrix(self.seqSize,weights,dtype=self.dtype)
+
+        self.bondMask = bonds[self.vecInd]*2         #a mask that allows for only accepted pairings
+        self.bonds0 = bonds*2     #the initial structure
+
+        #the working state is the contiguous vector of candidate pairs; the n x n
+        #bonds matrix is only filled in from it when somebody asks for it
+        self.state      = bonds[self.vecInd]
+        self.field      = np.empty_like(self.state)     #work buffers for epoch()
+        self.prevState  = np.empty_like(self.state)
+        self.bondMatrix = None
+        self.activation = None
+        self.trace = None       #an RNAtrace.Trace, see traceOn
+        self.groups = None      #conflict-free pair groups for asyncEpoch, found on first use
+        self.energyDrop = np.inf    #how much hopfieldEnergy fell over the last asyncEpoch
+        self.sweepEnergy = None     #(state,energy) after the last traced asyncEpoch
+
+        self.struct = None if struct is None else np.array(struct)
+        if struct is not None:
+            print(self.backBone.shape)
+            print(self.bonds0.shape)
+            print(self.struct.shape)
+
+    @property
+    def bonds(self):
+        if self.bondMatrix is None:
+            self.bondMatrix = np.zeros((self.seqSize,self.seqSize),dtype=self.state.dtype)
+        self.bondMatrix[self.vecInd] = self.state
+        return self.bondMatrix
+
+    @property
+    def graph(self):
+        if self.struct is not None:
+            return [self.backBone,self.bonds,self.struct]
+        return [self.backBone,self.bonds]
+
+
+    def actFunc(self,x,out=None):
+        out = np.tanh(x,out=out)       #sigmoid, output on (0,1)
         #np.putmask(out,np.random.rand(*x.shape)<(0.2/(self.epochCount+1)),1)  #randomly set some to 1
-        np.putmask(out,out<0,0)
+        np.maximum(out,0,out=out)
         return out
 
 
-    def saveBonds(self):
-        np.savez('RNAconnectivity.npz',bonds=self.bonds,chain=self.backBone)
+    def saveBonds(self,fileName='RNAconnectivity.npz'):
+        np.savez(fileName,bonds=self.bonds,chain=self.backBone)
+
+    def mutatedMask(self,position,base):
+        #the candidate pairs that involve position (its row and column of the pair matrix)
+        #and their bondMask once the base there is changed to base
+        baseDict = {'U':1,'G':2,'C':3,'A':4}
+        row = self.pairIndex[position,:]
+        col = self.pairIndex[:,position]
+        partners = np.concatenate((np.nonzero(row >= 0)[0],np.nonzero(col >= 0)[0]))
+        pairs = np.concatenate((row[row >= 0],col[col >= 0]))
+        pairSum = baseDict[base.upper()]+self.codes[partners]
+        allowed = (pairSum == 5) | (self.wobble & (pairSum == 3))
+        return pairs,allowed.astype(self.dtype)
+
+    def mutate(self,position,base,warm=True):
+        #changes the base at position in place, keeping the interactions; only the pairs in
+        #row and column position of the pair matrix change their mask: pairs the new base can't
+        #make are cleared and newly possible ones start from 0.5, as in a fresh network
+        #warm keeps every other pair where the last fold left it (before prune), so the next
+        #run starts near the old fixed point; otherwise the state restarts from the mask
+        if self.compressed:
+            raise ValueError('a compressed network only holds the pairs of its original sequence')
+        base = base.upper()
+        pairs,mask = self.mutatedMask(position,base)
+        newPairs = mask > self.bondMask[pairs]
+        self.bondMask[pairs] = mask
+        self.bonds0[self.vecInd[0][pairs],self.vecInd[1][pairs]] = mask
+        self.codes[position] = {'U':1,'G':2,'C':3,'A':4}[base]
+        self.sequence = self.sequence[:position]+base+self.sequence[position+1:]
+
+        if not warm:
+            self.state[:] = self.bondMask*0.5
+        elif self.activation is not None:
+            self.state[:] = self.activation
+        self.state[pairs] *= mask
+        self.state[pairs[newPairs]] = 0.5
+        self.activation = None
+        self.residual = np.inf
+
+    def traceOn(self,size=10000):
+        #records (epoch,seconds,residual,active pairs,energy) for every epoch from now on;
+        #the energy is -1/2 s.W.s of the state the epoch started from
+        self.trace = Trace(('epoch','seconds','residual','activePairs','energy'),size)
+        return self.trace
+
+    def traceOff(self):
+        self.trace = None
 
     def epoch(self):
-        activation = self.actFunc(np.dot(self.interactions,self.bonds[self.vecInd]))* self.bondMask
-        self.bonds[self.vecInd] = (1-self.learnCst)*self.bonds[self.vecInd] +self.learnCst*activation
+        #state = (1-learnCst)*state + learnCst*actFunc(interactions.state)*bondMask, in place
+        trace = self.trace      #read once, in case another thread switches it mid-epoch
+        if trace is not None:
+            start = time.perf_counter()
+        if isinstance(self.interactions,np.ndarray):
+            np.dot(self.interactions,self.state,out=self.field)
+        else:
+            self.field[:] = self.interactions.dot(self.state)
+        if trace is not None:
+            energy = -0.5*np.dot(self.state,self.field)      #the product is already there
+        self.actFunc(self.field,out=self.field)
+        self.field *= self.bondMask
+        self.field *= self.learnCst
+
+        np.copyto(self.prevState,self.state)
+        self.state *= 1-self.learnCst
+        self.state += self.field
+
+        np.subtract(self.state,self.prevState,out=self.prevState)
+        np.abs(self.prevState,out=self.prevState)
+        self.residual = self.prevState.max(initial=0)        #max-norm change, for convergence checks
         self.epochCount += 1
-
-    def run(self,epochs):
-        for x in range(epochs):
-            self.epoch()
+        if trace is not None:
+            trace.record(self.epochCount,time.perf_counter()-start,self.residual,
+                         np.count_nonzero(self.state > 0.5),energy)
+
+    def energy(self,state=None):
+        #E = -1/2 s.W.s
+        state = self.state if state is None else state
+        return -0.5*np.dot(state,self.interactions.dot(state))
+
+    def hopfieldEnergy(self,state=None):
+        #E plus the sum of G(s) = integral of arctanh from 0 to s, the Lyapunov function of
+        #graded tanh units; asyncEpoch never increases it (E alone can rise as pairs fade out)
+        state = self.state if state is None else state
+        return self.energy(state)+self.entropyTerm(state).sum()
+
+    def entropyTerm(self,s):
+        return 0.5*(xlogy(1+s,1+s)+xlogy(1-s,1-s))
+
+    def asyncEpoch(self):
+        #one sweep of block-asynchronous updates: each conflict-free group of pairs is set to
+        #actFunc of its current field in turn, a full step rather than a learnCst relaxation;
+        #as no pair in a group interacts with another, each group update is an exact
+        #minimization of hopfieldEnergy over its pairs, so the energy falls monotonically
+        #costs the same multiply-adds as epoch(), but usually needs several times fewer sweeps
+        if not isinstance(self.interactions,np.ndarray):
+            raise ValueError('asynchronous updates need a dense interactions matrix')
+        trace = self.trace
+        if trace is not None:
+            start = time.perf_counter()
+        if self.groups is None:
+            self.groups = conflictFreeGroups(self.interactions)
+
+        if trace is not None:
+            #the trace takes E of the state the sweep starts from, as epoch() does; it is carried
+            #over from the last traced sweep, and only recomputed if the state changed since
+            if self.sweepEnergy is None or not np.array_equal(self.sweepEnergy[0],self.state):
+                self.sweepEnergy = (self.state.copy(),self.energy())
+            energy = self.sweepEnergy[1]
+
+        np.copyto(self.prevState,self.state)
+        drop = 0
+        quadDrop = 0
+        for group in self.groups:
+            field = np.dot(self.interactions[group],self.state)
+            old = self.state[group]
+            new = self.actFunc(field)*self.bondMask[group]
+            #W is zero inside the group, so the energy change is exact and O(group)
+            quadDrop += np.dot(new-old,field)
+            drop += self.entropyTerm(old).sum()-self.entropyTerm(new).sum()
+            self.state[group] = new
+        self.energyDrop = drop+quadDrop
+
+        np.subtract(self.state,self.prevState,out=self.prevState)
+        np.abs(self.prevState,out=self.prevState)
+        self.residual = self.prevState.max(initial=0)
+        self.epochCount += 1
+        if trace is not None:
+            np.copyto(self.sweepEnergy[0],self.state)
+            self.sweepEnergy = (self.sweepEnergy[0],energy-quadDrop)
+            trace.record(self.epochCount,time.perf_counter()-start,self.residual,
+                         np.count_nonzero(self.state > 0.5),energy)
+
+    def run(self,epochs,tol=None,patience=3,save=True,fileName='RNAconnectivity.npz',
+            update='sync',energyTol=None):
+        #runs at most epochs epochs; with a tol, stops early once the largest change in
+        #the state vector has stayed below tol for patience epochs in a row
+        #update='async' sweeps with asyncEpoch instead, and with an energyTol also stops once
+        #hopfieldEnergy has fallen by less than energyTol per sweep for patience sweeps
+        #returns the number of epochs run and the final residual
+        #save writes the pruned bonds to fileName (give each concurrent run its own)
+        if energyTol is not None and update != 'async':
+            raise ValueError('energyTol needs update=\'async\': synchronous epochs can raise the energy')
+        step = self.asyncEpoch if update == 'async' else self.epoch
+        ran = 0
+        quiet = 0
+        while ran < epochs and quiet < patience:
+            step()
+            ran += 1
+            settled = tol is not None and self.residual < tol
+            if update == 'async' and energyTol is not None:
+                settled = settled or self.energyDrop < energyTol
+            quiet = quiet+1 if settled else 0
         self.prune()
-        self.saveBonds()
+        if save:
+            self.saveBonds(fileName)
+        return ran,self.residual
 
     def prune(self):
-        np.round(self.bonds,out=self.bonds)
+        self.activation = self.state.copy()     #kept for FoldResult.fromNetwork
+        np.round(self.state,out=self.state)
+
+    def result(self,activations=False):
+        #compact FoldResult of the current (pruned) structure
+        return FoldResult.fromNetwork(self,activations)
+
+
+def relaxColumns(net,states,masks,epochs,tol=None,patience=3):
+    #runs the epochs of net on every column of states at once (one matrix product per epoch),
+    #column c being held to the pairs allowed by masks[:,c]; with a tol, columns that have
+    #converged as in RNAssNetwork.run drop out of the product
+    #updates states in place and returns the epochs run and the final residual of each column
+    numCols = states.shape[1]
+    ran      = np.zeros(numCols,dtype=int)
+    quiet    = np.zeros(numCols,dtype=int)
+    residual = np.full(numCols,np.inf)
+    active   = np.arange(numCols)
+
+    for x in range(epochs):
+        active = active[quiet[active] < patience]
+        if active.size == 0:
+            break
+        cols = active if active.size < numCols else slice(None)
+
+        activation = net.actFunc(net.interactions.dot(states[:,cols]))*masks[:,cols]
+        newStates = (1-net.learnCst)*states[:,cols] +net.learnCst*activation
+        residual[active] = np.abs(newStates-states[:,cols]).max(axis=0,initial=0)
+        states[:,cols] = newStates
+        ran[active] += 1
+        if tol is not None:
+            quiet[active] = np.where(residual[active] < tol,quiet[active]+1,0)
+    return ran,residual
+
+
+def foldBatch(sequences,epochs,weights=None,matrixFree=False,tol=None,patience=3,wobble=False,dtype=float,
+              results=False):
+    #folds many strands at once: strands of the same length share one interactions operator
+    #and their state vectors are stacked as columns, so each epoch is a single matrix product
+    #with a tol, converged strands drop out of the product as in RNAssNetwork.run
+    #returns the pruned bond matrices in the order of sequences, as RNAssNetwork.run would leave them,
+    #or with results=True their FoldResults, including the pre-prune activations
+    groups = {}
+    for x,seq in enumerate(sequences):
+        groups.setdefault(len(seq),[]).append(x)
+
+    folded = [None]*len(sequences)
+    for members in groups.values():
+        #the interactions are built once per length and lent to the other strands, so the
+        #group shares one matrix even when it is too big for the interactions cache
+        net0 = RNAssNetwork(sequences[members[0]],weights,matrixFree=matrixFree,wobble=wobble,dtype=dtype)
+        nets = [net0]+[RNAssNetwork(sequences[x],weights,wobble=wobble,dtype=dtype,interactions=net0.interactions)
+                       for x in members[1:]]
+        states = np.column_stack([net.state for net in nets])
+        masks  = np.column_stack([net.bondMask for net in nets])
+        ran,residual = relaxColumns(nets[0],states,masks,epochs,tol,patience)
+
+        for col,(x,net) in enumerate(zip(members,nets)):
+            net.state[:] = states[:,col]
+            net.epochCount += ran[col]
+            net.residual = residual[col]
+            net.prune()
+            folded[x] = net.result(activations=True) if results else net.bonds
+    return folded
+
+
+def annealColumns(job):
+    #folds one block of restarts as the columns of a single matrix product; each column
+    #draws its noise from its own seed, so the result doesn't depend on how restarts are split
+    #also the worker of foldAnnealed's process pool
+    sequence,seeds,epochs,temp0,cooling,tol,patience,weights,matrixFree,wobble,dtype = job
+    net = RNAssNetwork(sequence,weights,matrixFree=matrixFree,wobble=wobble,dtype=dtype)
+    rngs = [np.random.default_rng(s) for s in seeds]
+    states = np.repeat(net.state[:,np.newaxis],len(seeds),axis=1)
+    mask = net.bondMask[:,np.newaxis]
+    noise = np.empty_like(states)
+    temp = temp0
+    quiet = 0
+    for x in range(epochs):
+        field = net.interactions.dot(states)
+        if temp > 0:
+            for col,rng in enumerate(rngs):
+                noise[:,col] = rng.standard_normal(len(noise))
+            field += temp*noise
+            temp = temp*cooling if temp*cooling > 1e-3*temp0 else 0     #then settle noise-free
+        newStates = (1-net.learnCst)*states +net.learnCst*net.actFunc(field)*mask
+        residual = np.abs(newStates-states).max(initial=0)
+        states = newStates
+        if tol is not None and temp == 0:
+            quiet = quiet+1 if residual < tol else 0
+            if quiet >= patience:
+                break
+    energies = [net.hopfieldEnergy(states[:,col]) for col in range(len(seeds))]
+    return states,np.array(energies)
+
+
+def foldAnnealed(sequence,restarts=8,epochs=1000,temp0=0.5,cooling=0.98,seed=0,tol=1e-6,patience=3,
+                 processes=None,weights=None,matrixFree=False,wobble=False,dtype=float):
+    #stochastic folding: restarts copies of the network start from the usual state and get
+    #gaussian noise of standard deviation temp added to their fields, with temp falling by
+    #cooling every epoch until it is negligible, after which they settle as in run()
+    #with processes=None all restarts are columns of one product against one shared
+    #interactions matrix; otherwise they are split over a process pool, one matrix per worker
+    #returns the pruned bonds of the restart with the lowest hopfieldEnergy, the fraction of
+    #restarts in which each pair formed, and the energy of every restart
+    seeds = np.random.SeedSequence(seed).spawn(restarts)
+    args = (epochs,temp0,cooling,tol,patience,weights,matrixFree,wobble,dtype)
+    if processes is None:
+        states,energies = annealColumns((sequence,seeds)+args)
+    else:
+        blocks = [seeds[x::processes] for x in range(processes) if seeds[x::processes]]
+        with Pool(processes) as pool:
+            done = pool.map(annealColumns,[(sequence,b)+args for b in blocks])
+        #put the columns back in restart order
+        order = np.concatenate([np.arange(restarts)[x::processes] for x in range(len(blocks))])
+        states = np.empty((done[0][0].shape[0],restarts),dtype=done[0][0].dtype)
+        energies = np.empty(restarts)
+        states[:,order] = np.hstack([d[0] for d in done])
+        energies[order] = np.concatenate([d[1] for d in done])
+
+    #the columns are in the row-based triu order of an uncompressed network
+    n = len(sequence)
+    vecInd = np.triu_indices(n,4)
+    pruned = np.round(states)
+    frequency = np.zeros((n,n))
+    frequency[vecInd] = pruned.mean(axis=1)
+    bonds = np.zeros((n,n),dtype=states.dtype)
+    bonds[vecInd] = pruned[:,np.argmin(energies)]
+    return bonds,frequency,energies
+
+
+scanNet = None      #the network of a mutationScan pool worker, see initScanWorker
+
+
+def initScanWorker(sequence,weights,matrixFree,wobble,dtype):
+    #builds the wild type's network (and so its interactions) once per worker process
+    global scanNet
+    scanNet = RNAssNetwork(sequence,weights,matrixFree=matrixFree,wobble=wobble,dtype=dtype)
+
+
+def mutantColumns(job,net=None):
+    #folds a block of single mutants of net's strand as the columns of one matrix product,
+    #each warm-started from the wild type's converged state; net is only read, never mutated
+    #also the mutationScan worker, which uses the network initScanWorker built
+    mutants,wildState,epochs,tol,patience = job
+    if net is None:
+        net = scanNet
+    states = np.repeat(wildState[:,np.newaxis],len(mutants),axis=1).astype(net.dtype)
+    masks  = np.repeat(net.bondMask[:,np.newaxis],len(mutants),axis=1)
+    for col,(position,base) in enumerate(mutants):
+        pairs,mask = net.mutatedMask(position,base)
+        newPairs = mask > masks[pairs,col]
+        masks[pairs,col] = mask
+        states[pairs,col] *= mask
+        states[pairs[newPairs],col] = 0.5
+    ran,residual = relaxColumns(net,states,masks,epochs,tol,patience)
+    pairs = []
+    for col in range(len(mutants)):
+        formed = np.nonzero(np.round(states[:,col]) > 0.5)[0]       #as prune() would leave them
+        pairs.append(np.column_stack((net.vecInd[0][formed],net.vecInd[1][formed])).astype(np.int32))
+    return pairs,ran
+
+
+def mutationScan(sequence,epochs=1000,tol=1e-6,patience=3,processes=None,weights=None,
+                 matrixFree=False,wobble=False,dtype=float,chunkSize=64):
+    #folds the wild type once, then every single mutant warm-started from it; the mutants
+    #share the wild type's interactions operator and are folded chunkSize at a time as columns
+    #of one product, in a process pool when processes is given (one operator per worker)
+    #returns the wild type's FoldResult and a list of (position,base,FoldResult,epochs run)
+    sequence = sequence.upper()
+    wild = RNAssNetwork(sequence,weights,matrixFree=matrixFree,wobble=wobble,dtype=dtype)
+    wild.run(epochs,tol,patience,save=False)
+    mutants = [(x,b) for x in range(len(sequence)) for b in 'ACGU' if b != sequence[x]]
+
+    jobs = [(mutants[c:c+chunkSize],wild.activation,epochs,tol,patience) for c in range(0,len(mutants),chunkSize)]
+    if processes is None:
+        done = [mutantColumns(job,wild) for job in jobs]
+    else:
+        with Pool(processes,initScanWorker,(sequence,weights,matrixFree,wobble,dtype)) as pool:
+            done = pool.map(mutantColumns,jobs)
+
+    results = []
+    for job,(pairs,ran) in zip(jobs,done):
+        for (position,base),p,r in zip(job[0],pairs,ran):
+            mutSeq = sequence[:position]+base+sequence[position+1:]
+            results.append((position,base,FoldResult(mutSeq,p),r))
+    return wild.result(),results
+
+
+def precisionCheck(sequences,epochs=300,tol=1e-6,dtype=np.float32):
+    #folds every strand at float64 and at dtype and returns the indices of the strands
+    #whose pruned structures differ (see README for the results on RNAstrands.rna)
+    mismatches = []
+    for x,seq in enumerate(sequences):
+        folds = []
+        for dt in (np.float64,dtype):
+            net = RNAssNetwork(seq,dtype=dt)
+            net.run(epochs,tol,save=False)
+            folds.append(net.bonds)
+        if not np.array_equal(*folds):
+            mismatches.append(x)
+    return mismatches
 
 
 class RNAlearner:
-    def __init__(self):
-        self.rcInhibit = -1/self.seqSize**1.5   #works for size 3
-        self.knotInhib = -1/self.seqSize**1.5
-        self.diagStim  = .4
+    def __init__(self,seqSize=76,weights=None):
+        if weights is not None:
+            self.rcInhibit,self.knotInhib,self.diagStim = weights
+        else:
+            self.rcInhibit = -1/seqSize**1.5   #works for size 3
+            self.knotInhib = -1/seqSize**1.5
+            self.diagStim  = .4
         self.learnCst  = 0.5
-        self.weights = [self.rcInhibit,self.knotInhib,self.diagStim]
+
+    @property
+    def weights(self):
+        return [self.rcInhibit,self.knotInhib,self.diagStim]
 
     def train(self,trainingSet,numEpochs=100):
         for seq,struct in trainingSet:
-            net = RNAssNetwork(seq,weights,struct)
-            net.run(numEpochs)
+            struct = np.asarray(struct)
+            if struct.shape != (len(seq),len(seq)):
+                print('skipping %s: structure is %s'%(seq,struct.shape))
+                continue
+            net = RNAssNetwork(seq,self.weights)
+            net.run(numEpochs,save=False)
             weightChg = self.delta(struct,net.bonds)
             self.rcInhibit += weightChg[0]
             self.knotInhib += weightChg[1]
             self.diagStim  += weightChg[2]
 
+    def trainParallel(self,trainingSet,numEpochs=100,batchSize=16,processes=None,seed=0,passes=1,nu=0.01):
+        #mini-batch training: the strands of a batch are folded in a process pool with the
+        #current weights and their weight changes are averaged before updating
+        #results come back in submission order, so a given seed always gives the same weights
+        #returns the (pass,batch,seconds,loss,weights) history, loss being the mean number of wrong pairs
+        valid = []
+        for seq,struct in trainingSet:
+            struct = np.asarray(struct)
+            if struct.shape != (len(seq),len(seq)):
+                print('skipping %s: structure is %s'%(seq,struct.shape))
+            else:
+                valid.append((seq,struct))
+
+        rng = np.random.RandomState(seed)
+        history = []
+        with Pool(processes) as pool:
+            for p in range(passes):
+                order = rng.permutation(len(valid))
+                for b,start in enumerate(range(0,len(order),batchSize)):
+                    t = time.time()
+                    jobs = [valid[x]+(self.weights,numEpochs,nu) for x in order[start:start+batchSize]]
+                    results = pool.map(foldGradient,jobs,chunksize=1)
+
+                    weightChg = np.mean([chg for chg,loss in results],axis=0)
+                    loss = np.mean([loss for chg,loss in results])
+                    self.rcInhibit += weightChg[0]
+                    self.knotInhib += weightChg[1]
+                    self.diagStim  += weightChg[2]
+
+                    history.append((p,b,time.time()-t,loss,self.weights))
+                    print('pass %d batch %d: %d strands in %.2fs, loss %.2f'%(p,b,len(jobs),history[-1][2],loss))
+        return history
+
     def delta(self,bPlus,bMinus,nu=0.01):
-        rcDel = 0
-        knotDel = 0
-        diagDel = 0
-        vecInd  = np.array(np.triu_indices_from(bPlus,4)).transpose()
-        for indI,i in enumerate(vecInd):
-            for j in vecInd[(indI+1):]:
-                d = nu* (bPlus[tuple(i)]*bPlus[tuple(j)]  -  bMinus[tuple(i)]*bMinus[tuple(j)])
-                if (i[0] == j[0]) or (i[1] == j[1]):
-                    rcDel -= d
-                elif (j[0]<i[1]) and (i[1]<j[1]):
-                    knotDel -= d
-                elif sum(i) == sum(j):
-                    diagDel -= d
+        #correlation differences summed over the row/column, knot and diagonal relations,
+        #counting each unordered pair of candidate positions once
+        bPlus  = np.asarray(bPlus)
+        bMinus = np.asarray(bMinus)
+        vecInd = np.triu_indices_from(bPlus,4)
+        sPlus  = bPlus[vecInd].astype(float)
+        sMinus = bMinus[vecInd].astype(float)
+        corr   = nu*(np.outer(sPlus,sPlus)-np.outer(sMinus,sMinus))
+
+        masks   = pairMasks(vecInd,maxStack=None)
+        rcDel   = -corr[masks['rowCol']].sum()
+        knotDel = -corr[masks['knot']].sum()
+        diagDel = -corr[masks['stack']].sum()
         return [rcDel,knotDel,diagDel]
 
 
+def foldGradient(job):
+    #worker for RNAlearner.trainParallel: folds one strand and returns its weight change
+    #and the number of pairs that differ from the target structure
+    seq,struct,weights,numEpochs,nu = job
+    net = RNAssNetwork(seq,weights)
+    net.run(numEpochs,save=False)
+    loss = np.abs(struct[net.vecInd]-net.state).sum()
+    return RNAlearner(weights=weights).delta(struct,net.bonds,nu),loss
+
+
 if __name__  == '__main__':
     #seq = 'GGGCCCGUAGCUCAGCCAGGACAGAGCGCCGGCCUUCUAAGCCGGUGCUGCCGGGUUCAAAUCCCGGCGGGCCCGCCA'
     #seq = 'AAACCCAUGCAUAGGGUUUG'
     seq = 'AACUAAGUU'
 
     rnaNet1 = RNAssNetwork(seq)
-    rnaNet1.run(20)
+    epochs,residual = rnaNet1.run(500,tol=1e-6)
+    print('converged after %d epochs (residual %.2g)'%(epochs,residual))
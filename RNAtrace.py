@@ -0,0 +1,50 @@
+import json
+
+import numpy as np
+
+
+class Trace:
+    #fixed-size ring buffer of numeric records, for watching a loop from outside it
+    #RNAssNetwork, SpringLayout and GLWidget each have a trace attribute that is None (no cost
+    #beyond the check) until a Trace is put there; recording is then a single row write, and
+    #once size records are in, each new one replaces the oldest
+    def __init__(self,fields,size=10000):
+        self.fields = tuple(fields)
+        self.data  = np.zeros((size,len(self.fields)))
+        self.count = 0      #records written so far, including the overwritten ones
+
+    def record(self,*values):
+        self.data[self.count % len(self.data)] = values
+        self.count += 1
+
+    def clear(self):
+        self.count = 0
+
+    def rows(self):
+        #(index,record) arrays of the records still held, oldest first
+        size = len(self.data)
+        start = max(0,self.count-size)
+        index = np.arange(start,self.count)
+        return index,self.data[index % size]
+
+    def column(self,field):
+        index,rows = self.rows()
+        return index,rows[:,self.fields.index(field)]
+
+    def toCSV(self,fileName):
+        index,rows = self.rows()
+        np.savetxt(fileName,np.column_stack((index,rows)),delimiter=',',
+                   header=','.join(('index',)+self.fields),comments='',fmt='%.10g')
+
+    def toJSON(self,fileName):
+        index,rows = self.rows()
+        with open(fileName,'w') as file:
+            json.dump({'fields':('index',)+self.fields,
+                       'rows':np.column_stack((index,rows)).tolist()},file)
+
+    def save(self,fileName):
+        #csv or json by extension
+        if fileName.endswith('.json'):
+            self.toJSON(fileName)
+        else:
+            self.toCSV(fileName)
@@ -1,7 +1,8 @@
 import numpy as np
-import scipy.linalg as linalg
 import itertools
 
+from RNAinteractions import interactionMatrix
+
 baseDict = {'U':1,'G':2,'C':3,'A':4}
 
 def actFunc(x):
@@ -33,31 +34,10 @@ backBone = np.zeros((seqSize,seqSize))
 backBone[range(seqSize-1),range(1,seqSize)] = 1     #backbone
 
 #creating the interactions matrix (for use with row-based triu)
-diags = [(np.ones((x,x))-np.eye(x))*rcInhibit for x in range(seqSize-4,0,-1)]
-
-interactions = linalg.block_diag(*diags).astype(float)
+#every non-nested pair is inhibited and stacking is stimulated at any distance
+interactions = interactionMatrix(seqSize,(rcInhibit,knotInhib,diagStim),maxStack=None,strictKnots=False)
 np.fill_diagonal(interactions,carry)    #feedback to self
 
-rOffset=0
-cOffset=0
-
-for d in range(1,seqSize-4):            #blockset diagonal - equivalent to row in the adjacency matrix
-    diags = []                          #holder for the blocks for the diagonal
-
-    for cn in range(seqSize-4-d,0,-1):            #height for the block
-        block = np.zeros((cn,cn+d))               #initialize the block
-        block[range(cn),  range(d,cn+d)  ]  = rcInhibit         #inhibition along the block's diagonal d
-        block[range(cn-d),range(2*d,cn+d)]  = diagStim/d          #stimulation along the block's diagonal d*2  --this could be turned into a neighbourhood function
-        block += np.tril(np.ones((cn,cn+d))*knotInhib, d-1)     #knot inhibition below the block's diagonal d
-        diags.append(block)
-
-    diagBlocks = linalg.block_diag(*diags).astype(float)     #create block diagonal matrix for this diagonal
-
-    rOffset += seqSize-3-d
-    cOffset -= d
-    interactions[rOffset:,:cOffset] +=diagBlocks
-    interactions[:cOffset,rOffset:] +=diagBlocks.transpose()
-
 
 
 np.savez('RNAconnectivity.npz',conn,backBone)
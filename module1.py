@@ -1,6 +1,3 @@
-import pickle as pkl
-
-with open('RNAstrands.rna',mode='rb') as file:
-    RNAiter = pkl.load(file)
-
+from RNAdataset import StrandStore
 
+RNAiter = StrandStore('RNAstrands.store')      #converted from RNAstrands.rna by RNAdataset.py
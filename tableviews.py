@@ -5,6 +5,47 @@ from PySide import QtCore, QtGui
 
 import numpy as np
 
+from RNAinteractions import pairIndexTable
+
+
+#background colours by level: shades of red for negative values, green for positive ones
+redShades   = [QtGui.QColor(255,255-x,255-x) for x in range(256)]
+greenShades = [QtGui.QColor(255-x,255,255-x) for x in range(256)]
+
+def colorLevels(a,nrmP,nrmN):
+    #signed colour level of every cell in one pass: -255..-1 for negative values (relative to
+    #nrmN), 1..255 for positive ones (relative to nrmP) and 0 for zeros
+    a = np.asarray(a,dtype=float)
+    levels = np.zeros(a.shape,dtype=np.int16)
+    neg = a<0
+    pos = a>0
+    if nrmN != 0:
+        levels[neg] = -np.clip(255*a[neg]/nrmN,1,255)
+    if nrmP != 0:
+        levels[pos] = np.clip(255*a[pos]/nrmP,1,255)
+    return levels
+
+def heatmap(a,nrmP,nrmN,maxSize=1024):
+    #RGB image of a, shrunk so that neither side exceeds maxSize; each pixel shows the value
+    #of largest magnitude in its block, so that isolated weights stay visible
+    a = np.asarray(a)
+    f = int(np.ceil(max(a.shape)/maxSize))
+    if f > 1:
+        h,w = -(-a.shape[0]//f),-(-a.shape[1]//f)
+        padded = np.zeros((h*f,w*f))
+        padded[:a.shape[0],:a.shape[1]] = a
+        blocks = padded.reshape(h,f,w,f).transpose(0,2,1,3).reshape(h,w,f*f)
+        pick = np.abs(blocks).argmax(axis=2)
+        a = np.take_along_axis(blocks,pick[...,np.newaxis],2)[...,0]
+
+    levels = colorLevels(a,nrmP,nrmN)
+    shade  = (255-np.abs(levels)).astype(np.uint8)
+    rgb = np.full(levels.shape+(3,),255,dtype=np.uint8)
+    rgb[...,1] = np.where(levels<0,shade,255)
+    rgb[...,2] = shade
+    rgb[...,0] = np.where(levels>0,shade,255)
+    return rgb
+
 
 class WeightTableModel(QtCore.QAbstractTableModel):
     def __init__(self,a):
@@ -12,6 +53,12 @@ class WeightTableModel(QtCore.QAbstractTableModel):
         self.dataArray=a
         self.nrmP = np.max(self.dataArray)
         self.nrmN = 1.4*np.min(self.dataArray)
+        self.levels = None      #colour levels, computed on the first paint
+
+    def colorLevels(self):
+        if self.levels is None:
+            self.levels = colorLevels(self.dataArray,self.nrmP,self.nrmN)
+        return self.levels
 
     def rowCount(self,parent=None):
         return self.dataArray.shape[0]
@@ -20,59 +67,88 @@ class WeightTableModel(QtCore.QAbstractTableModel):
         return self.dataArray.shape[1]
 
     def data(self,index,role):
-        val = self.dataArray[index.row(),index.column()]
         if role == QtCore.Qt.DisplayRole:
-            return '%.2f'%val
+            return '%.2f'%self.dataArray[index.row(),index.column()]
         elif role == QtCore.Qt.TextAlignmentRole:
             return QtCore.Qt.AlignCenter
         elif role == QtCore.Qt.BackgroundRole:
-            if val<0:
-                c = 255*(1-val/self.nrmN)
-                return QtGui.QColor(255,c,c)
-            elif val>0:
-                c = 255*(1-val/self.nrmP)
-                return QtGui.QColor(c,255,c)
+            level = self.colorLevels()[index.row(),index.column()]
+            if level<0:
+                return redShades[-level]
+            elif level>0:
+                return greenShades[level]
 
 
 class WeightTableView(QtGui.QWidget):
-    def __init__(self,parent=None,data=None):
+    def __init__(self,parent=None,data=None,heatmapRows=500):
         QtGui.QWidget.__init__(self,parent)
         self.table = QtGui.QTableView(parent)
+        self.table.horizontalHeader().setResizeMode(QtGui.QHeaderView.Fixed)
+        self.table.verticalHeader().setResizeMode(QtGui.QHeaderView.Fixed)
         if data is not None:
             self.model_ = WeightTableModel(data)
             self.table.setModel(self.model_)
         self.changeSize(35)
 
+        #downsampled picture of the whole matrix, drawn the first time it's shown
+        self.heatmapLabel = QtGui.QLabel()
+        self.heatmapScroll = QtGui.QScrollArea()
+        self.heatmapScroll.setWidget(self.heatmapLabel)
+        self.heatmapData = None
+        self.pages = QtGui.QStackedWidget()
+        self.pages.addWidget(self.table)
+        self.pages.addWidget(self.heatmapScroll)
+
         v_box = QtGui.QVBoxLayout()
         self.setLayout(v_box)
+        h_box = QtGui.QHBoxLayout()
+        v_box.addLayout(h_box)
         self.sizeCtrl = QtGui.QSpinBox()
         self.sizeCtrl.setMaximum(50)
         self.sizeCtrl.setValue(35)
         self.sizeCtrl.valueChanged.connect(self.changeSize)
-        v_box.addWidget(self.sizeCtrl)
-        v_box.addWidget(self.table)
-
+        h_box.addWidget(self.sizeCtrl)
+        self.heatmapBtn = QtGui.QCheckBox("Heatmap")
+        self.heatmapBtn.toggled.connect(self.showHeatmap)
+        h_box.addWidget(self.heatmapBtn)
+        v_box.addWidget(self.pages)
+
+        if data is not None and self.model_.rowCount() > heatmapRows:
+            self.heatmapBtn.setChecked(True)        #too big to browse cell by cell at first
+
+    def showHeatmap(self,checked):
+        if checked and self.heatmapData is None:
+            rgb = heatmap(self.model_.dataArray,self.model_.nrmP,self.model_.nrmN)
+            self.heatmapData = rgb.tobytes()     #QImage doesn't copy the buffer
+            image = QtGui.QImage(self.heatmapData,rgb.shape[1],rgb.shape[0],3*rgb.shape[1],
+                                 QtGui.QImage.Format_RGB888)
+            self.heatmapLabel.setPixmap(QtGui.QPixmap.fromImage(image))
+            self.heatmapLabel.adjustSize()
+        self.pages.setCurrentIndex(1 if checked else 0)
 
     def changeSize(self,newSize):
-        for x in range(self.model_.columnCount()):
-            self.table.setColumnWidth(x,newSize)
-        for x in range(self.model_.rowCount()):
-            self.table.setRowHeight(x,newSize)
-        self.model_.layoutChanged.emit()
+        self.table.horizontalHeader().setDefaultSectionSize(newSize)
+        self.table.verticalHeader().setDefaultSectionSize(newSize)
 
 
 class StructTableModel(QtCore.QAbstractTableModel):
-    def __init__(self,view,bonds,interactions):
+    def __init__(self,view,bonds,interactions,pairIndex=None):
         QtCore.QAbstractTableModel.__init__(self)
         self.view = view
         self.bondData = bonds
         self.interactionData = interactions
-        self.vecInd  = np.triu_indices_from(bonds,4)
+        if pairIndex is None:
+            pairIndex = pairIndexTable(bonds.shape[0],np.triu_indices_from(bonds,4))
+        self.pairIndex = pairIndex      #(i,j) -> row of the interactions, as RNAssNetwork.pairIndex
+        self.vecInd  = np.nonzero(pairIndex>=0)
         self.colors = np.zeros_like(bonds)
         self.dispMode = 'Struct'
         self.nrmB = np.max(self.bondData)
-        self.nrmP = np.max(self.interactionData)
-        self.nrmN = 1.4*np.min(self.interactionData)
+        if isinstance(interactions,np.ndarray):     #normalize by the whole matrix, once
+            self.nrmP = np.max(self.interactionData)
+            self.nrmN = 1.4*np.min(self.interactionData)
+        else:
+            self.nrmP = self.nrmN = None      #matrix-free: normalize by each row as it's shown
 
     def rowCount(self,parent=None):
         return self.bondData.shape[0]
@@ -80,19 +156,43 @@ class StructTableModel(QtCore.QAbstractTableModel):
     def columnCount(self,parent=None):
         return self.bondData.shape[1]
 
+    def interactionRow(self,x):
+        if isinstance(self.interactionData,np.ndarray):
+            return self.interactionData[x,:]
+        unit = np.zeros(self.interactionData.shape[1])
+        unit[x] = 1
+        return self.interactionData.dot(unit)      #the interactions are symmetric
+
     def selectionChg(self,index=None):
         r = index.row()
         c = index.column()
         if r>c:
             r,c = c,r
-        m = self.bondData.shape[1]
-        x = sum(range(m-4,m-r-4,-1))+(c-r-4)
-        self.colors[self.vecInd] = self.interactionData[x,:]
-        print(self.interactionData[x,:])
-        self.nrmP = np.max(self.interactionData)
-        self.nrmN = 1.4*np.min(self.interactionData)
+        x = self.pairIndex[r,c]
+        if x < 0:
+            return
+        row = self.interactionRow(x)
+        print(row)
+        oldNorms = (self.nrmP,self.nrmN,self.nrmB)
+        if not isinstance(self.interactionData,np.ndarray):
+            self.nrmP = np.max(row)
+            self.nrmN = 1.4*np.min(row)
         self.nrmB = np.max(self.bondData)
-        self.layoutChanged.emit()
+
+        oldColors = self.colors[self.vecInd]
+        self.colors[self.vecInd] = row
+
+        if self.dispMode == 'Struct' or oldNorms != (self.nrmP,self.nrmN,self.nrmB):
+            #the bonds (or the colour scale) may have moved since the last selection
+            self.dataChanged.emit(self.index(0,0),self.index(self.rowCount()-1,self.columnCount()-1))
+            return
+
+        #only the cells whose colour changed (and their mirror images) need repainting
+        changed = np.nonzero(oldColors != row)[0]
+        if changed.size:
+            lo = min(self.vecInd[0][changed].min(),self.vecInd[1][changed].min())
+            hi = max(self.vecInd[0][changed].max(),self.vecInd[1][changed].max())
+            self.dataChanged.emit(self.index(lo,lo),self.index(hi,hi))
 
     def data(self,index,role):
         if index.row() < index.column():
@@ -129,7 +229,7 @@ class StructTableModel(QtCore.QAbstractTableModel):
 
 
 class StructTableView(QtGui.QWidget):
-    def __init__(self,parent=None,bonds=None,interactions=None):
+    def __init__(self,parent=None,bonds=None,interactions=None,pairIndex=None):
         QtGui.QWidget.__init__(self,parent)
         v_box = QtGui.QVBoxLayout()
         self.setLayout(v_box)
@@ -140,8 +240,10 @@ class StructTableView(QtGui.QWidget):
 
         self.table = QtGui.QTableView(parent)
         self.table.setSelectionMode(QtGui.QAbstractItemView.SingleSelection)
+        self.table.horizontalHeader().setResizeMode(QtGui.QHeaderView.Fixed)
+        self.table.verticalHeader().setResizeMode(QtGui.QHeaderView.Fixed)
         if bonds is not None:
-            self.model_ = StructTableModel(self,bonds,interactions)
+            self.model_ = StructTableModel(self,bonds,interactions,pairIndex)
             self.table.setModel(self.model_)
             self.changeSize(35)
 
@@ -174,11 +276,8 @@ class StructTableView(QtGui.QWidget):
         self.model_.layoutChanged.emit()
 
     def changeSize(self,newSize):
-        for x in range(self.model_.columnCount()):
-            self.table.setColumnWidth(x,newSize)
-        for x in range(self.model_.rowCount()):
-            self.table.setRowHeight(x,newSize)
-        self.model_.layoutChanged.emit()
+        self.table.horizontalHeader().setDefaultSectionSize(newSize)
+        self.table.verticalHeader().setDefaultSectionSize(newSize)
 
 
 
@@ -0,0 +1,102 @@
+import numpy as np
+import pytest
+import scipy.linalg as linalg
+
+from RNAinteractions import InteractionOperator, conflictFreeGroups, interactionMatrix
+from RNAssNetwork import RNAssNetwork, foldBatch
+
+
+def loopMatrix(seqSize,weights,strictKnots=True):
+    #the block_diag construction the interactions matrix was first built with;
+    #strictKnots=True is the RNAssNetwork variant, False the firstMatrix.py one (without carry)
+    rcInhibit,knotInhib,diagStim = weights
+    diags = [(np.ones((x,x))-np.eye(x))*rcInhibit for x in range(seqSize-4,0,-1)]
+    interactions = linalg.block_diag(*diags).astype(float)
+
+    rOffset=0
+    cOffset=0
+    for d in range(1,seqSize-4):
+        diags = []
+        for cn in range(seqSize-4-d,0,-1):
+            block = np.zeros((cn,cn+d))
+            block[range(cn),  range(d,cn+d)  ]  = rcInhibit
+            if d<4 or not strictKnots:
+                block[range(cn-d),range(2*d,cn+d)]  = diagStim/d
+            block += np.tril(np.ones((cn,cn+d))*knotInhib, d-1)
+            if d>4 and strictKnots:
+                block[:,d-4].fill(rcInhibit)
+                block[:,0:(d-4)].fill(0)
+            diags.append(block)
+
+        diagBlocks = linalg.block_diag(*diags).astype(float)
+
+        rOffset += seqSize-3-d
+        cOffset -= d
+        interactions[rOffset:,:cOffset] +=diagBlocks
+        interactions[:cOffset,rOffset:] +=diagBlocks.transpose()
+    return interactions
+
+
+def weightsFor(seqSize):
+    return (-2/seqSize**2,-1/seqSize**2,.4)
+
+
+@pytest.mark.parametrize('seqSize',range(5,41))
+def test_matrix_matches_loop(seqSize):
+    weights = weightsFor(seqSize)
+    assert np.allclose(interactionMatrix(seqSize,weights),loopMatrix(seqSize,weights),rtol=0,atol=1e-12)
+
+
+@pytest.mark.parametrize('seqSize',range(5,41))
+def test_first_matrix_variant_matches_loop(seqSize):
+    weights = (-0.7/np.sqrt(seqSize),-0.7/np.sqrt(seqSize),.4)
+    dense = interactionMatrix(seqSize,weights,maxStack=None,strictKnots=False)
+    assert np.allclose(dense,loopMatrix(seqSize,weights,strictKnots=False),rtol=0,atol=1e-12)
+
+
+@pytest.mark.parametrize('seqSize',[5,6,9,17,30,40])
+def test_operator_matches_matrix(seqSize):
+    weights = weightsFor(seqSize)
+    dense = interactionMatrix(seqSize,weights)
+    op = InteractionOperator(seqSize,weights)
+    X = np.random.default_rng(seqSize).random((dense.shape[0],3))
+    assert np.allclose(op.matmat(X),dense.dot(X),rtol=0,atol=1e-12)
+    assert np.allclose(op.matvec(X[:,0]),dense.dot(X[:,0]),rtol=0,atol=1e-12)
+
+
+@pytest.mark.parametrize('sequence,compressed',[('ACGU',False),('AAAAAAAAAAAA',True)])
+def test_async_without_candidate_pairs(sequence,compressed):
+    #no pairs to colour: the sweep, the energy and the residual are all no-ops
+    net = RNAssNetwork(sequence,compressed=compressed)
+    assert conflictFreeGroups(net.interactions) == []
+    ran,residual = net.run(5,1e-6,update='async',save=False)
+    assert residual == 0 and not net.bonds.any()
+
+
+#hairpins that form stems at the default weights (two of equal length, and one that gains
+#G-U pairs with wobble), a strand that forms none and strands too short to have candidate pairs
+strands = ['GGGGGGAAAACCCCCC','CCCCCCAAAAGGGGGG','GGGGGGGGAAAACCCCCCCC','GCGCGCGCGAAAAGCGCGCGCGC',
+           'CCCCGGGGAAAAUUUUCCCCGGGG','GGGGGGGGGGGGAAAACCCCCCCCCCCC','GGGAAACCCAUGGGAAACCC','ACGU','GC']
+
+
+@pytest.mark.parametrize('matrixFree',[False,True])
+@pytest.mark.parametrize('tol',[None,1e-6])
+@pytest.mark.parametrize('wobble',[False,True])
+def test_fold_batch_matches_run(matrixFree,tol,wobble):
+    folded = foldBatch(strands,200,matrixFree=matrixFree,tol=tol,wobble=wobble)
+    for seq,bonds in zip(strands,folded):
+        net = RNAssNetwork(seq,matrixFree=matrixFree,wobble=wobble)
+        net.run(200,tol,save=False)
+        assert np.array_equal(bonds,net.bonds)
+
+
+@pytest.mark.parametrize('sequence',strands)
+@pytest.mark.parametrize('matrixFree',[False,True])
+@pytest.mark.parametrize('wobble',[False,True])
+def test_compressed_matches_full(sequence,matrixFree,wobble):
+    folds = []
+    for compressed in (False,True):
+        net = RNAssNetwork(sequence,matrixFree=matrixFree,wobble=wobble,compressed=compressed)
+        net.run(200,1e-6,save=False)
+        folds.append(net.bonds)
+    assert np.array_equal(*folds)
@@ -0,0 +1,86 @@
+# live plots of RNAtrace.Trace records
+
+from PySide import QtCore, QtGui
+
+import numpy as np
+
+
+class TracePlot(QtGui.QWidget):
+    #line plot of one field of a trace, redrawn from whatever the ring buffer holds
+    def __init__(self,parent=None):
+        QtGui.QWidget.__init__(self,parent)
+        self.trace = None
+        self.field = None
+        self.setMinimumSize(400,200)
+
+    def setSeries(self,trace,field):
+        self.trace,self.field = trace,field
+        self.update()
+
+    def paintEvent(self,event):
+        painter = QtGui.QPainter(self)
+        painter.fillRect(self.rect(),QtCore.Qt.white)
+        if self.trace is None or self.trace.count < 2:
+            painter.drawText(self.rect(),QtCore.Qt.AlignCenter,'no records yet')
+            return
+
+        index,values = self.trace.column(self.field)
+        lo,hi = np.min(values),np.max(values)
+        span = hi-lo if hi > lo else 1
+        margin = 20
+        w,h = self.width()-2*margin,self.height()-2*margin
+        xs = margin+w*(index-index[0])/max(1,index[-1]-index[0])
+        ys = margin+h*(1-(values-lo)/span)
+
+        painter.setRenderHint(QtGui.QPainter.Antialiasing)
+        painter.setPen(QtGui.QPen(QtCore.Qt.blue,1))
+        painter.drawPolyline(QtGui.QPolygonF([QtCore.QPointF(x,y) for x,y in zip(xs,ys)]))
+        painter.setPen(QtCore.Qt.black)
+        painter.drawText(margin,margin-5,'%.4g'%hi)
+        painter.drawText(margin,self.height()-5,'%.4g   (last %.4g, %d records)'%(lo,values[-1],self.trace.count))
+
+
+class TraceView(QtGui.QWidget):
+    #picks one series out of several traces, plots it live and exports its trace
+    #sources is a list of (label,trace,field)
+    def __init__(self,parent=None,sources=()):
+        QtGui.QWidget.__init__(self,parent)
+        self.sources = list(sources)
+        v_box = QtGui.QVBoxLayout()
+        self.setLayout(v_box)
+
+        btns = QtGui.QWidget()
+        btnLayout = QtGui.QHBoxLayout()
+        btns.setLayout(btnLayout)
+        v_box.addWidget(btns)
+
+        self.seriesBox = QtGui.QComboBox()
+        self.seriesBox.addItems([label for label,trace,field in self.sources])
+        self.seriesBox.currentIndexChanged.connect(self.chooseSeries)
+        btnLayout.addWidget(self.seriesBox)
+
+        exportBtn = QtGui.QPushButton('Export...')
+        exportBtn.clicked.connect(self.export)
+        btnLayout.addWidget(exportBtn)
+
+        self.plot = TracePlot()
+        v_box.addWidget(self.plot)
+        self.setWindowTitle('Trace')
+        self.chooseSeries(0)
+
+        self.timer = QtCore.QTimer()
+        self.timer.timeout.connect(self.plot.update)
+        self.timer.setInterval(250)
+        self.timer.start()
+
+    def chooseSeries(self,x):
+        if 0 <= x < len(self.sources):
+            label,trace,field = self.sources[x]
+            self.plot.setSeries(trace,field)
+
+    def export(self):
+        label,trace,field = self.sources[self.seriesBox.currentIndex()]
+        fileName,filt = QtGui.QFileDialog.getSaveFileName(self,'Export trace','trace.csv',
+                                                          'CSV (*.csv);;JSON (*.json)')
+        if fileName:
+            trace.save(fileName)